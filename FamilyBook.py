@@ -7,27 +7,55 @@
 # Standard Python modules
 #
 #------------------------------------------------------------------------
+import cProfile
+import gc
+import hashlib
+import heapq
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import pstats
+import queue
+import re
+import shutil
+import signal
+import sqlite3
 import string
-from collections import defaultdict
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from contextlib import contextmanager
 from functools import partial
+from itertools import islice, tee
 
 #------------------------------------------------------------------------
 #
 # Gramps modules
 #
 #------------------------------------------------------------------------
+from gramps.cli.user import User
+from gramps.gen.db import DBMODE_R
+from gramps.gen.db.utils import make_database
+from gramps.gen.errors import HandleError, ReportError
 from gramps.gen.display.name import displayer
 from gramps.gen.display.place import displayer as place_displayer
-from gramps.gen.lib import Date, Event, EventType, FamilyRelType, Name, NameType, Person, Family, Place, EventRoleType, NoteType
+from gramps.gen.lib import ChildRefType, Date, Event, EventRef, EventType, FamilyRelType, Name, NameOriginType, NameType, Person, Family, Place, EventRoleType, NoteType
 from gramps.gen.lib import StyledText, StyledTextTag, StyledTextTagType
 from gramps.gen.plug import docgen
-from gramps.gen.plug.menu import BooleanOption, EnumeratedListOption, PersonOption
+from gramps.gen.plug.menu import BooleanOption, DestinationOption, EnumeratedListOption, NumberOption, PersonOption, StringOption
 from gramps.gen.plug.report import MenuReportOptions
 from gramps.gen.plug.report import Report
 from gramps.gen.plug.report import stdoptions
 from gramps.gen.plug.report import utils
 import gramps.gen.datehandler
-from gramps.gen.relationship import get_relationship_calculator
+from gramps.gen.relationship import RelationshipCalculator, get_relationship_calculator
+from gramps.gen.utils.file import media_path_full
 from gramps.gen.const import GRAMPS_LOCALE as glocale
 try:
     _trans = glocale.get_addon_translator(__file__)
@@ -35,6 +63,16 @@ except ValueError:
     _trans = glocale.translation
 _ = _trans.gettext
 
+#------------------------------------------------------------------------
+#
+# Optional modules
+#
+#------------------------------------------------------------------------
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
 #------------------------------------------------------------------------
 #
 # Constants
@@ -43,8 +81,2501 @@ _ = _trans.gettext
 empty_birth = Event()
 empty_birth.set_type(EventType.BIRTH)
 
-empty_marriage = Event()
-empty_marriage.set_type(EventType.MARRIAGE)
+empty_marriage = Event()
+empty_marriage.set_type(EventType.MARRIAGE)
+
+# number of persons sent to a chapter rendering worker at once
+_CHAPTER_BATCH = 64
+
+# maximum number of threads reading the objects of the chapters ahead,
+# each with its own database connection
+_PIPELINE_READERS = 4
+
+# size of the output buffer of a LaTeX file written directly
+_TEX_BUFFER_SIZE = 1 << 20
+
+# maximum number of place titles and dates kept formatted
+_FORMAT_CACHE_SIZE = 20000
+
+# records sorted in memory before they are spilled to a run file, and
+# records per block of a run file, in the low memory mode
+_SPILL_RUN = 100000
+_SPILL_BLOCK = 1000
+
+# maximum number of database objects kept in memory in the low memory mode
+_SPILL_CACHE_SIZE = 20000
+
+# print size of the portraits in millimetres, and their resolution in dots
+# per inch
+_PHOTO_WIDTH = 30
+_PHOTO_HEIGHT = 40
+_PHOTO_DPI = 300
+
+# number of progress updates of a phase, and items per update if the
+# number of items is not known in advance
+_PROGRESS_STEPS = 200
+_PROGRESS_PULSE = 1000
+
+# number of persons and profiled functions listed in performance statistics
+_SLOWEST_PERSONS = 20
+_PROFILED_FUNCTIONS = 30
+
+# positions of fields inside serialized (raw) object tuples
+_PERSON_GRAMPS_ID = 1
+_PERSON_PRIMARY_NAME = 3
+_PERSON_ALTERNATE_NAMES = 4
+_PERSON_BIRTH_REF_INDEX = 6
+_PERSON_EVENT_REFS = 7
+_PERSON_FAMILIES = 8
+_PERSON_PARENT_FAMILIES = 9
+_PERSON_MEDIA = 10
+_PERSON_NOTES = 16
+_PERSON_CHANGE = 17
+
+_NAME_FIRST_NAME = 4
+_NAME_SURNAMES = 5
+_NAME_TYPE = 8
+
+_SURNAME_SURNAME = 0
+_SURNAME_PRIMARY = 2
+_SURNAME_ORIGIN = 3
+
+_EVENT_REF_REF = 4
+
+_CHILD_REF_REF = 3
+_CHILD_REF_FATHER_REL = 4
+_CHILD_REF_MOTHER_REL = 5
+
+_EVENT_GRAMPS_ID = 1
+_EVENT_TYPE = 2
+_EVENT_DATE = 3
+_DATE_SORTVAL = 5
+_EVENT_DESCRIPTION = 4
+_EVENT_PLACE = 5
+_EVENT_CITATIONS = 6
+_EVENT_CHANGE = 10
+
+_FAMILY_GRAMPS_ID = 1
+_FAMILY_FATHER = 2
+_FAMILY_MOTHER = 3
+_FAMILY_CHILDREN = 4
+_FAMILY_EVENT_REFS = 6
+_FAMILY_CHANGE = 12
+
+_CITATION_GRAMPS_ID = 1
+_CITATION_PAGE = 3
+_CITATION_SOURCE = 5
+_CITATION_CHANGE = 9
+
+_SOURCE_GRAMPS_ID = 1
+_SOURCE_TITLE = 2
+_SOURCE_AUTHOR = 3
+_SOURCE_PUBINFO = 4
+_SOURCE_CHANGE = 8
+
+_NOTE_GRAMPS_ID = 1
+_NOTE_TEXT = 2
+_NOTE_TYPE = 4
+_NOTE_CHANGE = 5
+
+_PLACE_PLACEREFS = 5
+_PLACE_CHANGE = 15
+
+_PLACEREF_REF = 0
+
+_MEDIA_REF_REF = 4
+_MEDIA_REF_RECT = 5
+
+_MEDIA_PATH = 2
+_MEDIA_MIME = 3
+
+# LaTeX replacements of the characters special to LaTeX in note text
+_LATEX_ESCAPES = {
+    '\\': '\\textbackslash{}',
+    '{': '\\{',
+    '}': '\\}',
+    '$': '\\$',
+    '&': '\\&',
+    '#': '\\#',
+    '^': '\\^{}',
+    '_': '\\_',
+    '%': '\\%',
+    '~': '\\textasciitilde{}',
+    '\xa0': '~',
+    '&nbsp;': '~',
+    }
+_LATEX_SPECIALS = re.compile(r'&nbsp;|[\\{}$&#^_%~\xa0]')
+# characters escaped in the URL argument of \href
+_URL_SPECIALS = re.compile(r'[\\{}#%]')
+_URL_SCHEMES = re.compile('(https?|ftp|mailto):', re.IGNORECASE)
+# note text paragraphs, LaTeX commands of tags are closed around breaks
+_PARAGRAPH_BREAKS = re.compile(r'\n[ \t]*\n\s*')
+
+# LaTeX commands opened by note text tags, links are handled separately
+_TAG_COMMANDS = {
+    StyledTextTagType.BOLD: '\\textbf{',
+    StyledTextTagType.ITALIC: '\\emph{',
+    StyledTextTagType.UNDERLINE: '\\underline{',
+    StyledTextTagType.STRIKETHROUGH: '\\sout{',
+    StyledTextTagType.SUPERSCRIPT: '\\textsuperscript{',
+    StyledTextTagType.SUBSCRIPT: '\\textsubscript{',
+    }
+
+
+#------------------------------------------------------------------------
+#
+# Functions
+#
+#------------------------------------------------------------------------
+def _raw_surname(name_data):
+    """
+    Return the primary surname of a raw name, like Name.get_surname().
+    """
+    surnames = name_data[_NAME_SURNAMES]
+    for surname in surnames:
+        if surname[_SURNAME_PRIMARY]:
+            return surname[_SURNAME_SURNAME]
+    if surnames:
+        return surnames[0][_SURNAME_SURNAME]
+    return ''
+
+def _raw_given_name(name_data):
+    """
+    Return the given name of a raw name followed by its patronymic or
+    matronymic, if any, as filed under the surname in the name index.
+    """
+    parts = [name_data[_NAME_FIRST_NAME]]
+    for surname in name_data[_NAME_SURNAMES]:
+        if (not surname[_SURNAME_PRIMARY] and
+                surname[_SURNAME_ORIGIN][0] in (NameOriginType.PATRONYMIC,
+                                                NameOriginType.MATRONYMIC)):
+            parts.append(surname[_SURNAME_SURNAME])
+    return ' '.join(part for part in parts if part)
+
+def _escape_latex(text):
+    """
+    Return plain text with the characters special to LaTeX escaped.
+    """
+    return _LATEX_SPECIALS.sub(lambda match: _LATEX_ESCAPES[match.group()],
+                               text)
+
+def _tag_command(tag):
+    """
+    Return the LaTeX command opening the text of a StyledTextTag, None if
+    the tag has none.
+    """
+    tag_type = int(tag.name)
+    if tag_type == StyledTextTagType.LINK:
+        # internal gramps:// links have no meaning in the book
+        if not _URL_SCHEMES.match(tag.value):
+            return None
+        url = _URL_SPECIALS.sub(lambda match: '\\' + match.group(), tag.value)
+        return '\\href{' + url + '}{'
+    return _TAG_COMMANDS.get(tag_type)
+
+def _styled_text_to_latex(styledtext):
+    """
+    Convert a StyledText to LaTeX in one pass over the text and its tags.
+
+    Overlapping and adjacent ranges of the same command are merged first.
+    As LaTeX commands have to nest, at every range boundary the commands
+    opened after an ending one are closed and reopened; all commands are
+    also closed around paragraph breaks.
+
+    @param styledtext: StyledText of a note
+    @return: LaTeX text
+    """
+    text = str(styledtext)
+    ranges = defaultdict(list)
+    for tag in styledtext.get_tags():
+        command = _tag_command(tag)
+        if command is not None:
+            ranges[command] += [(start, end) for (start, end) in tag.ranges
+                                if start < end]
+    spans = []
+    for (command, command_ranges) in ranges.items():
+        command_ranges.sort()
+        (start, end) = (None, None)
+        for (range_start, range_end) in command_ranges:
+            if end is not None and range_start <= end:
+                end = max(end, range_end)
+                continue
+            if end is not None:
+                spans.append((start, end, command))
+            (start, end) = (range_start, range_end)
+        if end is not None:
+            spans.append((start, end, command))
+    if not spans:
+        return _escape_latex(text)
+
+    # outer (longer) spans first among the ones starting together
+    spans.sort(key = lambda span: (span[0], -span[1]))
+    boundaries = sorted(set([0, len(text)] +
+                            [span[0] for span in spans] +
+                            [span[1] for span in spans]))
+    out = []
+    stack = []
+    next_span = 0
+    for (pos, next_pos) in zip(boundaries, boundaries[1:]):
+        # close the spans ending here, with all the ones opened after them
+        reopen = []
+        while any(span[1] <= pos for span in stack):
+            span = stack.pop()
+            out.append('}')
+            if span[1] > pos:
+                reopen.append(span)
+        while next_span < len(spans) and spans[next_span][0] == pos:
+            reopen.append(spans[next_span])
+            next_span += 1
+        for span in sorted(reopen, key = lambda span: -span[1]):
+            out.append(span[2])
+            stack.append(span)
+
+        commands = ''.join(span[2] for span in stack)
+        segment = text[pos:next_pos]
+        last = 0
+        for match in _PARAGRAPH_BREAKS.finditer(segment):
+            out += [_escape_latex(segment[last:match.start()]),
+                    '}' * len(stack), match.group(), commands]
+            last = match.end()
+        out.append(_escape_latex(segment[last:]))
+    out.append('}' * len(stack))
+    return ''.join(out)
+
+def _birth_parents(family_data, child_ref_data):
+    """
+    Return the handles of the parents in a raw family the child of a raw
+    child reference is born to.
+    """
+    parents = []
+    for (parent_index, rel_index) in ((_FAMILY_FATHER, _CHILD_REF_FATHER_REL),
+                                      (_FAMILY_MOTHER, _CHILD_REF_MOTHER_REL)):
+        if (family_data[parent_index] and
+                child_ref_data[rel_index][0] == ChildRefType.BIRTH):
+            parents.append(family_data[parent_index])
+    return parents
+
+def _open_database_copy(database):
+    """
+    Open a private read-only connection to the family tree of the database.
+
+    Databases which are not stored in a family tree directory (e.g.
+    in-memory stand-ins) are returned as is, a snapshot is put in front of
+    the new connection.
+    """
+    if isinstance(database, DatabaseSnapshot):
+        return database.reopen()
+    path = database.get_save_path()
+    if not path or not os.path.isdir(path):
+        return database
+    dbid = 'bsddb'
+    backend_file = os.path.join(path, 'database.txt')
+    if os.path.isfile(backend_file):
+        with open(backend_file) as backend:
+            dbid = backend.read().strip()
+    copy = make_database(dbid)
+    copy.load(path, mode = DBMODE_R)
+    return copy
+
+def _date_key(date):
+    """
+    Return a hashable key identifying the value of a Date object, i.e. its
+    sort value, quality and modifier along with the calendar, the exact
+    date values, the text and the new year setting.
+    """
+    return date.serialize()
+
+@contextmanager
+def _no_phase():
+    yield
+
+@contextmanager
+def _no_gc():
+    """
+    Context manager pausing the cyclic garbage collector, which would walk
+    all the objects of the report over and over while many small tuples are
+    allocated, e.g. sort keys. No reference cycles may be made meanwhile.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def _is_gui_user(user):
+    """
+    Tell whether the report runs in the Gramps GUI, without importing it.
+    """
+    return type(user).__module__ == 'gramps.gui.user'
+
+# the report instance of a chapter rendering worker process
+_worker_report = None
+
+def _init_chapter_worker(report):
+    """
+    Initialize a forked chapter rendering worker process.
+    """
+    global _worker_report
+    report._reopen_database()
+    _worker_report = report
+
+def _render_chapters(person_handles):
+    """
+    Render the chapters of a batch of persons in a worker process.
+
+    @return: tuple of (list of chapters, instrumentation data or None)
+    """
+    chapters = [_worker_report._render_chapter(handle)
+                for handle in person_handles]
+    if _worker_report.instrumentation is None:
+        return (chapters, None)
+    return (chapters, _worker_report.instrumentation.take())
+
+def _file_digest(filename):
+    """
+    Return the SHA-1 digest of the contents of a file.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as source:
+        for block in iter(partial(source.read, 1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _thumbnail_name(digest, region, size):
+    """
+    Return the file name of the thumbnail of an image region of a size.
+    """
+    name = digest
+    if region:
+        name += '-%d-%d-%d-%d' % tuple(region)
+    return '%s-%dx%d.jpg' % (name, size[0], size[1])
+
+def _make_thumbnail(task):
+    """
+    Make the thumbnail of an image, if not made yet: crop the image to the
+    region and to the proportions of the size, and scale it down to the
+    size. Runs in thumbnail worker processes as well.
+
+    @param task: tuple of (image file, digest of the file or None if not
+                 known, region as (x1, y1, x2, y2) in percent of the image
+                 or None, size in pixels, thumbnail directory)
+    @return: tuple of (digest, thumbnail file name, whether it was made),
+             None if the image can not be read
+    """
+    (filename, digest, region, size, directory) = task
+    try:
+        if digest is None:
+            digest = _file_digest(filename)
+        name = _thumbnail_name(digest, region, size)
+        target = os.path.join(directory, name)
+        if os.path.exists(target):
+            return (digest, name, False)
+        with Image.open(filename) as image:
+            (x1, y1, x2, y2) = region or (0, 0, 100, 100)
+            # large JPEG scans are decoded at the smallest scale still
+            # giving the thumbnail its full resolution
+            image.draft('RGB', (size[0] * 100 // max(1, x2 - x1),
+                                size[1] * 100 // max(1, y2 - y1)))
+            (width, height) = image.size
+            image = image.convert('RGB')
+            if region:
+                image = image.crop((width * x1 // 100, height * y1 // 100,
+                                    width * x2 // 100, height * y2 // 100))
+            image = ImageOps.fit(image, size, Image.LANCZOS)
+        # books of a batch may make the same thumbnail at once
+        temp = '%s.%d' % (target, os.getpid())
+        image.save(temp, 'JPEG', quality = 90)
+        os.replace(temp, target)
+    except (IOError, OSError, ValueError):
+        return None
+    return (digest, name, True)
+
+# the batch report and database snapshot of a book rendering worker process
+_worker_batch = None
+
+def _batch_file_name(filename, person_id):
+    """
+    Return the name of the file of a book of a batch: the person ID is
+    inserted before the extension.
+    """
+    (base, ext) = os.path.splitext(filename)
+    return '%s-%s%s' % (base, person_id, ext)
+
+def _init_book_worker(report, snapshot):
+    """
+    Initialize a forked book rendering worker process of a batch.
+    """
+    global _worker_batch
+    # the user interface of the parent process must not be driven from
+    # the worker, its progress is not reported and its warnings go to
+    # the standard error output
+    report.user = User(quiet = True)
+    snapshot.database = _open_database_copy(snapshot.database)
+    _worker_batch = (report, snapshot)
+
+def _write_book(person_id):
+    """
+    Write the book of a center person of a batch in a worker process.
+    """
+    (report, snapshot) = _worker_batch
+    report._write_book(snapshot, person_id, jobs = 1)
+
+
+#------------------------------------------------------------------------
+#
+# Output writers
+#
+#------------------------------------------------------------------------
+class DocWriter(object):
+    """
+    Writes blocks of LaTeX through the document generator, one paragraph
+    per block.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.part = None
+
+    def write(self, text):
+        if self.part is not None:
+            self.part.append(text)
+            return
+        self.doc.start_paragraph('FSR-Normal')
+        self.doc.write_text(text)
+        self.doc.end_paragraph()
+
+    def write_part(self, name, text):
+        self.write(text)
+
+    def begin_part(self, name):
+        """
+        Start a part written in pieces with write(); the document gets it
+        in one paragraph, as if written with write_part().
+        """
+        self.part = []
+
+    def end_part(self):
+        (text, self.part) = (''.join(self.part), None)
+        self.write(text)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+class TexWriter(object):
+    """
+    Writes blocks of LaTeX straight into a buffered file.
+    """
+
+    def __init__(self, filename):
+        self.file = io.open(filename, 'w', encoding = 'utf-8',
+                            buffering = _TEX_BUFFER_SIZE)
+
+    def write(self, text):
+        self.file.write(text)
+
+    def write_part(self, name, text):
+        self.write(text)
+
+    def begin_part(self, name):
+        """
+        Start a part written in pieces with write().
+        """
+        pass
+
+    def end_part(self):
+        pass
+
+    def close(self):
+        self.file.close()
+
+    def abort(self):
+        """
+        Drop the incomplete file.
+        """
+        self.file.close()
+        os.remove(self.file.name)
+
+class SplitTexWriter(object):
+    """
+    Writes every part (person chapter, bibliography) into its own file
+    pulled into the master document with \\include, so that LaTeX builds
+    may be restricted to some parts with \\includeonly.
+
+    A manifest with the SHA-256 hash of every file is written next to the
+    master document. Files whose content did not change are not rewritten,
+    which keeps their modification time for latexmk and make.
+    """
+
+    def __init__(self, filename):
+        """
+        @param filename: path of the master document
+        """
+        base = os.path.splitext(filename)[0]
+        self.filename = filename
+        self.part_dir = os.path.basename(base) + '-parts'
+        self.manifest_file = base + '.manifest.json'
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.master = []
+        self.parts = []
+        self.manifest = {}
+        self.old_manifest = {}
+        # (name, temporary file, hash) of the part being written in pieces
+        self.part = None
+        if os.path.isfile(self.manifest_file):
+            with io.open(self.manifest_file, encoding = 'utf-8') as manifest:
+                self.old_manifest = json.load(manifest)
+        part_path = os.path.join(self.directory, self.part_dir)
+        if not os.path.isdir(part_path):
+            os.makedirs(part_path)
+
+    def write(self, text):
+        if self.part is None:
+            self.master.append(text)
+            return
+        data = text.encode('utf-8')
+        self.part[1].write(data)
+        self.part[2].update(data)
+
+    def write_part(self, name, text):
+        name = self.__part_name(name)
+        self.__write_file(name + '.tex', text)
+        self.__add_part(name)
+
+    def begin_part(self, name):
+        """
+        Start a part written in pieces with write(). The pieces go to a
+        temporary file, which replaces the part file unless the content
+        did not change.
+        """
+        name = self.__part_name(name)
+        path = os.path.join(self.directory, name + '.tex')
+        self.part = (name, open(path + '.tmp', 'wb'), hashlib.sha256())
+
+    def end_part(self):
+        (name, output, digest) = self.part
+        self.part = None
+        output.close()
+        digest = digest.hexdigest()
+        path = os.path.join(self.directory, name + '.tex')
+        if (self.old_manifest.get(name + '.tex') == digest and
+                os.path.isfile(path)):
+            os.remove(output.name)
+        else:
+            os.replace(output.name, path)
+        self.manifest[name + '.tex'] = digest
+        self.__add_part(name)
+
+    def __part_name(self, name):
+        return self.part_dir + '/' + re.sub(r'[^A-Za-z0-9_-]', '_', name)
+
+    def __add_part(self, name):
+        self.parts.append(name)
+        self.master.append('\\include{' + name + '}\n')
+
+    def close(self):
+        master = ''.join(self.master)
+        include_only = '\\includeonly{' + ',\n'.join(self.parts) + '}\n'
+        master = master.replace('\\begin{document}',
+                                include_only + '\\begin{document}', 1)
+        self.__write_file(os.path.basename(self.filename), master)
+        # drop parts which are no longer in the book
+        for name in self.old_manifest:
+            if name not in self.manifest:
+                path = os.path.join(self.directory, name)
+                if os.path.isfile(path):
+                    os.remove(path)
+        self.__write_manifest(self.manifest)
+
+    def abort(self):
+        """
+        Leave the master document as it was; the parts written so far are
+        complete and their hashes replace the old ones in the manifest, so
+        that it keeps matching the files.
+        """
+        if self.part is not None:
+            self.part[1].close()
+            os.remove(self.part[1].name)
+            self.part = None
+        manifest = dict(self.old_manifest)
+        manifest.update(self.manifest)
+        self.__write_manifest(manifest)
+
+    def __write_manifest(self, manifest):
+        with io.open(self.manifest_file, 'w', encoding = 'utf-8') as output:
+            json.dump(manifest, output, indent = 1, sort_keys = True)
+
+    def __write_file(self, name, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.directory, name)
+        if self.old_manifest.get(name) != digest or not os.path.isfile(path):
+            with open(path, 'wb') as output:
+                output.write(data)
+        # recorded once the file is complete, for abort()
+        self.manifest[name] = digest
+
+
+#------------------------------------------------------------------------
+#
+# Progress
+#
+#------------------------------------------------------------------------
+class Progress(object):
+    """
+    Context manager reporting the progress of a report phase through the
+    user, at most _PROGRESS_STEPS times however many items there are.
+
+    The progress dialog of the GUI user has no cancel button, so a phase
+    which can be cancelled opens its own dialog with one instead.
+    """
+
+    def __init__(self, user, message, total = 0, cancel_event = None):
+        """
+        @param user: a gramps.gen.user.User() instance
+        @param message: description of the phase
+        @param total: number of items, 0 if not known
+        @param cancel_event: threading.Event() set by the cancel button of
+            the progress dialog, None if the phase cannot be cancelled
+        """
+        self.user = user
+        self.message = message
+        self.cancel_event = cancel_event
+        self.meter = None
+        if total:
+            self.stride = (total + _PROGRESS_STEPS - 1) // _PROGRESS_STEPS
+            self.steps = total // self.stride
+        else:
+            self.stride = _PROGRESS_PULSE
+            self.steps = 0
+        self.countdown = self.stride
+
+    def __enter__(self):
+        if self.cancel_event is not None and _is_gui_user(self.user):
+            # only imported under the GUI, it needs Gtk
+            from gramps.gui.utils import ProgressMeter
+            self.meter = ProgressMeter(_('Family Book'), can_cancel = True,
+                                       cancel_callback = self.__cancel,
+                                       parent = self.user.parent)
+            if self.steps:
+                self.meter.set_pass(self.message, self.steps,
+                                    ProgressMeter.MODE_FRACTION)
+            else:
+                self.meter.set_pass(self.message,
+                                    mode = ProgressMeter.MODE_ACTIVITY)
+        else:
+            self.user.begin_progress(_('Family Book'), self.message,
+                                     self.steps)
+        return self
+
+    def __exit__(self, *args):
+        if self.meter is not None:
+            self.meter.close()
+            self.meter = None
+        else:
+            self.user.end_progress()
+        return False
+
+    def __cancel(self, *args):
+        """
+        Cancel button callback of the progress dialog.
+        """
+        self.meter.handle_cancel()
+        self.cancel_event.set()
+        # keeps the dialog open when closed, until the chapter is written
+        return True
+
+    def step(self):
+        """
+        Count an item done.
+        """
+        self.countdown -= 1
+        if not self.countdown:
+            self.countdown = self.stride
+            if self.meter is not None:
+                # runs the GUI events, the cancel button among them
+                self.meter.step()
+            else:
+                self.user.step_progress()
+
+
+#------------------------------------------------------------------------
+#
+# Instrumentation
+#
+#------------------------------------------------------------------------
+class Instrumentation(object):
+    """
+    Call counters and timers of the operations and phases of a report run.
+
+    Times of nested operations are inclusive, e.g. the time of displaying
+    a place includes the database reads it triggers.
+    """
+
+    def __init__(self):
+        # operation name -> [calls, total time, max time]
+        self.operations = {}
+        self.phases = []
+        # heap of the (render time, gramps_id) of the slowest persons
+        self.persons = []
+
+    def wrap(self, name, function):
+        """
+        Return function wrapped with the counter and timer of an operation.
+        """
+        operation = self.operations.setdefault(name, [0, 0.0, 0.0])
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                operation[0] += 1
+                operation[1] += elapsed
+                if elapsed > operation[2]:
+                    operation[2] = elapsed
+        return timed
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager recording the wall time of a report phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def add_person(self, gramps_id, seconds):
+        """
+        Record the render time of the chapter of a person.
+        """
+        if len(self.persons) < _SLOWEST_PERSONS:
+            heapq.heappush(self.persons, (seconds, gramps_id))
+        else:
+            heapq.heappushpop(self.persons, (seconds, gramps_id))
+
+    def take(self):
+        """
+        Return the collected operation and person data and reset them,
+        for merging the data of a worker process into the main one.
+        """
+        data = (dict((name, list(operation))
+                     for (name, operation) in self.operations.items()),
+                self.persons)
+        for operation in self.operations.values():
+            operation[:] = [0, 0.0, 0.0]
+        self.persons = []
+        return data
+
+    def merge(self, data):
+        """
+        Merge data returned by take() of another instance.
+        """
+        (operations, persons) = data
+        for (name, (calls, total, longest)) in operations.items():
+            operation = self.operations.setdefault(name, [0, 0.0, 0.0])
+            operation[0] += calls
+            operation[1] += total
+            operation[2] = max(operation[2], longest)
+        for (seconds, gramps_id) in persons:
+            self.add_person(gramps_id, seconds)
+
+    def summary(self):
+        """
+        Return the collected data as a JSON serializable dictionary.
+        """
+        return {
+            'phases': OrderedDict((name, round(seconds, 6))
+                                  for (name, seconds) in self.phases),
+            'operations': OrderedDict(
+                (name, {'calls': calls, 'total': round(total, 6),
+                        'max': round(longest, 6)})
+                for (name, (calls, total, longest))
+                in sorted(self.operations.items(),
+                          key = lambda item: -item[1][1])
+                if calls),
+            'slowest_persons': [
+                {'gramps_id': gramps_id, 'seconds': round(seconds, 6)}
+                for (seconds, gramps_id) in sorted(self.persons, reverse = True)],
+            }
+
+class InstrumentedDatabase(object):
+    """
+    Database proxy counting and timing the calls of every method.
+    """
+
+    def __init__(self, database, instrumentation):
+        self.database = database
+        self.instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if not callable(attr):
+            return attr
+        timed = self.instrumentation.wrap('db.' + name, attr)
+        setattr(self, name, timed)
+        return timed
+
+
+#------------------------------------------------------------------------
+#
+# ChapterCache
+#
+#------------------------------------------------------------------------
+class ChapterCache(object):
+    """
+    On-disk SQLite cache of rendered person chapters.
+
+    Every entry holds the chapter text, the cited citation handles and the
+    place entries of a person together with the signature of the data it
+    was rendered from.
+    """
+
+    def __init__(self, filename):
+        """
+        @param filename: path of the SQLite cache file, created if missing
+        """
+        self.connection = sqlite3.connect(filename)
+        columns = [row[1] for row in
+                   self.connection.execute('PRAGMA table_info(chapter)')]
+        if columns and 'places' not in columns:
+            # written by an older version of the report
+            self.connection.execute('DROP TABLE chapter')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS chapter ('
+                                'handle TEXT PRIMARY KEY, signature TEXT, '
+                                'text TEXT, citations TEXT, places TEXT)')
+        self.reused = 0
+        self.rebuilt = 0
+
+    def is_valid(self, handle, signature):
+        """
+        Return True if the cached chapter of the person is up to date.
+        """
+        row = self.connection.execute(
+            'SELECT signature FROM chapter WHERE handle = ?', (handle,)).fetchone()
+        return row is not None and row[0] == signature
+
+    def load(self, handle):
+        """
+        Return the cached (chapter text, citation handles, place entries)
+        of the person.
+        """
+        (text, citations, places) = self.connection.execute(
+            'SELECT text, citations, places FROM chapter WHERE handle = ?',
+            (handle,)).fetchone()
+        self.reused += 1
+        return (text, json.loads(citations), json.loads(places))
+
+    def store(self, handle, signature, chapter):
+        """
+        Store the (chapter text, citation handles, place entries) of the
+        person.
+        """
+        (text, citations, places) = chapter
+        self.connection.execute(
+            'INSERT OR REPLACE INTO chapter VALUES (?, ?, ?, ?, ?)',
+            (handle, signature, text, json.dumps(citations),
+             json.dumps(places)))
+        self.rebuilt += 1
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+#------------------------------------------------------------------------
+#
+# ThumbnailCache
+#
+#------------------------------------------------------------------------
+class ThumbnailCache(object):
+    """
+    Directory of the portraits of the persons, cropped and scaled to the
+    print size.
+
+    Thumbnails are named by the digest of the image file, the region and
+    the size, so an image is scaled once however many persons and runs use
+    it. An index of the modification times and sizes of the image files
+    spares hashing unchanged files again.
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, directory, size):
+        """
+        @param directory: directory of the thumbnails, created if missing
+        @param size: (width, height) of the thumbnails in pixels
+        """
+        self.directory = directory
+        self.size = size
+        # image file -> [modification time, file size, digest]
+        self.index = {}
+        self.index_file = os.path.join(directory, self.INDEX_FILE)
+        if os.path.isfile(self.index_file):
+            with io.open(self.index_file, encoding = 'utf-8') as index:
+                self.index = json.load(index)
+        # (image file, region) -> handles of the persons it is a portrait of
+        self.portraits = defaultdict(list)
+        # person handle -> thumbnail file name
+        self.thumbnails = {}
+        self.made = 0
+        self.reused = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self.portraits)
+
+    def add(self, handle, filename, region):
+        """
+        Add the portrait of a person.
+
+        @param handle: handle of the person
+        @param filename: full path of the image file
+        @param region: (x1, y1, x2, y2) in percent of the image, or None
+        """
+        self.portraits[(filename, region)].append(handle)
+
+    def get(self, handle):
+        """
+        Return the thumbnail file name of the portrait of a person, None if
+        there is none.
+        """
+        return self.thumbnails.get(handle)
+
+    def get_signature(self):
+        """
+        Return the signature of the portraits before the thumbnails are
+        made: the image files with their modification times and sizes, the
+        regions and the persons, without reading the images.
+        """
+        items = []
+        for ((filename, region), handles) in sorted(self.portraits.items(),
+                                                    key = repr):
+            try:
+                stat = os.stat(filename)
+                stat = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                stat = None
+            items.append((filename, region, stat, sorted(handles)))
+        items.append(self.size)
+        return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+    def make(self, jobs):
+        """
+        Make the missing thumbnails of the portraits, in worker processes if
+        several jobs are allowed, yielding the image files one by one.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        images = list(self.portraits)
+        stats = []
+        tasks = []
+        for (filename, region) in images:
+            digest = None
+            try:
+                stat = os.stat(filename)
+                stat = [stat.st_mtime_ns, stat.st_size]
+                if self.index.get(filename, [])[:2] == stat:
+                    digest = self.index[filename][2]
+            except OSError:
+                stat = None
+            stats.append(stat)
+            tasks.append((filename, digest, region, self.size,
+                          self.directory))
+
+        if (jobs > 1 and len(tasks) > 1 and
+                'fork' in multiprocessing.get_all_start_methods()):
+            with ProcessPoolExecutor(
+                    max_workers = jobs,
+                    mp_context = multiprocessing.get_context('fork')) as executor:
+                results = executor.map(_make_thumbnail, tasks, chunksize = 8)
+                for (image, stat, result) in zip(images, stats, results):
+                    self.__add_thumbnail(image, stat, result)
+                    yield image[0]
+        else:
+            for (image, stat, task) in zip(images, stats, tasks):
+                self.__add_thumbnail(image, stat, _make_thumbnail(task))
+                yield image[0]
+
+        temp = '%s.%d' % (self.index_file, os.getpid())
+        with io.open(temp, 'w', encoding = 'utf-8') as index:
+            json.dump(self.index, index, indent = 1, sort_keys = True)
+        os.replace(temp, self.index_file)
+
+    def __add_thumbnail(self, image, stat, result):
+        if result is None:
+            self.failed += 1
+            return
+        (digest, name, made) = result
+        if made:
+            self.made += 1
+        else:
+            self.reused += 1
+        if stat is not None:
+            self.index[image[0]] = stat + [digest]
+        for handle in self.portraits[image]:
+            self.thumbnails[handle] = name
+
+
+#------------------------------------------------------------------------
+#
+# ObjectCache
+#
+#------------------------------------------------------------------------
+class ObjectCache(object):
+    """
+    Report-scoped LRU cache of primary objects sitting in front of the
+    database.
+
+    Provides the get_*_from_handle methods used by the report, every other
+    attribute is delegated to the wrapped database, so an instance may be
+    passed wherever Gramps expects a database (e.g. to place_displayer).
+    """
+
+    OBJECT_TYPES = ('person', 'family', 'event', 'citation', 'source',
+                    'place', 'note')
+
+    def __init__(self, database, size = 0):
+        """
+        @param database: the Gramps database instance
+        @param size: maximum number of cached objects, 0 means unbounded
+        """
+        self.database = database
+        self.size = size
+        self.__objects = OrderedDict()
+        self.hits = dict.fromkeys(self.OBJECT_TYPES, 0)
+        self.misses = dict.fromkeys(self.OBJECT_TYPES, 0)
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    def __get(self, obj_type, handle, fetch):
+        key = (obj_type, handle)
+        try:
+            obj = self.__objects[key]
+        except KeyError:
+            self.misses[obj_type] += 1
+            obj = fetch(handle)
+            self.__objects[key] = obj
+            if self.size and len(self.__objects) > self.size:
+                self.__objects.popitem(last = False)
+            return obj
+        self.hits[obj_type] += 1
+        self.__objects.move_to_end(key)
+        return obj
+
+    def __contains__(self, key):
+        """
+        Return True if the object of the (object type, handle) key is
+        cached.
+        """
+        return key in self.__objects
+
+    def prime(self, obj_type, handle, obj):
+        """
+        Add an object read elsewhere (e.g. by the reader threads of the
+        chapter pipeline), unless it is cached already.
+        """
+        key = (obj_type, handle)
+        if key not in self.__objects:
+            self.__objects[key] = obj
+            if self.size and len(self.__objects) > self.size:
+                self.__objects.popitem(last = False)
+
+    def get_person_from_handle(self, handle):
+        return self.__get('person', handle, self.database.get_person_from_handle)
+
+    def get_family_from_handle(self, handle):
+        return self.__get('family', handle, self.database.get_family_from_handle)
+
+    def get_event_from_handle(self, handle):
+        return self.__get('event', handle, self.database.get_event_from_handle)
+
+    def get_citation_from_handle(self, handle):
+        return self.__get('citation', handle, self.database.get_citation_from_handle)
+
+    def get_source_from_handle(self, handle):
+        return self.__get('source', handle, self.database.get_source_from_handle)
+
+    def get_place_from_handle(self, handle):
+        return self.__get('place', handle, self.database.get_place_from_handle)
+
+    def get_note_from_handle(self, handle):
+        return self.__get('note', handle, self.database.get_note_from_handle)
+
+    def get_stats(self):
+        """
+        Return a list of (object type, hits, misses) tuples.
+        """
+        return [(obj_type, self.hits[obj_type], self.misses[obj_type])
+                for obj_type in self.OBJECT_TYPES]
+
+
+#------------------------------------------------------------------------
+#
+# Chapter pipeline
+#
+#------------------------------------------------------------------------
+class StageQueue(object):
+    """
+    Queue between two threads of the chapter pipeline, recording how many
+    items the consumer finds waiting and how long the threads wait.
+    """
+
+    def __init__(self, size = 0):
+        """
+        @param size: maximum number of queued items, 0 means unbounded
+        """
+        self.queue = queue.Queue(size)
+        self.size = size
+        self.items = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        # seconds the producer waited on a full queue and the consumer on
+        # an empty one
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            start = time.perf_counter()
+            self.queue.put(item)
+            self.put_wait += time.perf_counter() - start
+
+    def get(self):
+        depth = self.queue.qsize()
+        self.items += 1
+        self.depth_total += depth
+        if depth > self.depth_max:
+            self.depth_max = depth
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.get_wait += time.perf_counter() - start
+            return item
+
+    def get_stats(self):
+        """
+        Return a dictionary of the depth and wait statistics.
+        """
+        return OrderedDict((
+            ('size', self.size),
+            ('items', self.items),
+            ('mean_depth', round(self.depth_total / self.items, 3)
+                           if self.items else 0.0),
+            ('max_depth', self.depth_max),
+            ('producer_stall', round(self.put_wait, 6)),
+            ('consumer_stall', round(self.get_wait, 6))))
+
+class ChapterReader(object):
+    """
+    Reader stage of the chapter pipeline: threads reading the objects the
+    chapters of the next persons are rendered from, each through its own
+    database connection, for the object cache of the rendering thread.
+
+    The rendering thread requests the persons in chapter order, at most
+    depth of them ahead of the chapter being rendered, and takes the
+    objects read in the same order.
+    """
+
+    def __init__(self, database, cache, records, depth, threads):
+        """
+        @param database: the Gramps database (or a snapshot of it)
+        @param cache: the ObjectCache of the rendering thread; cached
+                      objects are not read again
+        @param records: dictionary of object type -> dictionary of handle
+                        -> prefetched record, of the types not cached
+        @param depth: number of persons requested ahead
+        @param threads: number of reader threads
+        """
+        self.database = database
+        self.cache = cache
+        self.records = records
+        self.depth = depth
+        self.requests = queue.Queue()
+        # (person handle, future of the objects read) in request order
+        self.ready = deque()
+        # keys of the objects read but not cached yet
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target = self.__run,
+                                         name = 'FamilyBook reader %d' % i)
+                        for i in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+        self.items = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        # seconds the readers waited for requests, summed over the
+        # threads, and the renderer waited for objects
+        self.idle = 0.0
+        self.stall = 0.0
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def request(self, person_handle):
+        """
+        Request the objects of the chapter of a person.
+        """
+        future = Future()
+        self.ready.append((person_handle, future))
+        self.requests.put((person_handle, future))
+
+    def get(self):
+        """
+        Return (person handle, list of (object type, handle, object)) of the
+        earliest person requested, None if none is left.
+        """
+        if not self.ready:
+            return None
+        depth = sum(1 for (handle, future) in self.ready if future.done())
+        self.items += 1
+        self.depth_total += depth
+        if depth > self.depth_max:
+            self.depth_max = depth
+        (person_handle, future) = self.ready.popleft()
+        if not future.done():
+            start = time.perf_counter()
+            wait([future])
+            self.stall += time.perf_counter() - start
+        return (person_handle, future.result())
+
+    def done(self, objects):
+        """
+        Forget the objects read once they are in the object cache.
+        """
+        with self.lock:
+            self.pending.difference_update(
+                (obj_type, handle) for (obj_type, handle, obj) in objects)
+
+    def stop(self):
+        """
+        Drop the requests left and wait for the threads to end.
+        """
+        for (handle, future) in self.ready:
+            future.cancel()
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def get_stats(self):
+        """
+        Return a dictionary of the statistics of the objects found read
+        when the renderer takes them and of the waits.
+        """
+        return OrderedDict((
+            ('size', self.depth),
+            ('threads', len(self.threads)),
+            ('items', self.items),
+            ('mean_depth', round(self.depth_total / self.items, 3)
+                           if self.items else 0.0),
+            ('max_depth', self.depth_max),
+            ('producer_stall', round(self.idle, 6)),
+            ('consumer_stall', round(self.stall, 6))))
+
+    def __run(self):
+        database = self.database
+        error = None
+        try:
+            database = _open_database_copy(self.database)
+        except Exception as exc:
+            error = exc
+        try:
+            while True:
+                start = time.perf_counter()
+                request = self.requests.get()
+                with self.lock:
+                    self.idle += time.perf_counter() - start
+                if request is None:
+                    return
+                (person_handle, future) = request
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                    continue
+                try:
+                    future.set_result(self.__read(database, person_handle))
+                except Exception as exc:
+                    future.set_exception(exc)
+        finally:
+            if database is not self.database:
+                database.close()
+
+    def __read(self, database, person_handle):
+        """
+        Read a person with the events, families, citations, sources, notes
+        and places (with the enclosing ones) the chapter is rendered from,
+        except for the objects cached or read for other chapters already.
+        """
+        objects = []
+        person = self.__get(database, objects, 'person', person_handle)
+        if person is None:
+            return objects
+        event_handles = [event_ref.ref for event_ref
+                         in person.get_event_ref_list()]
+        for fam_handle in person.get_family_handle_list():
+            family = self.__get(database, objects, 'family', fam_handle)
+            if family is not None:
+                event_handles += [event_ref.ref for event_ref
+                                  in family.get_event_ref_list()]
+        place_handles = []
+        for event_handle in event_handles:
+            event = self.__get(database, objects, 'event', event_handle)
+            if event is None:
+                continue
+            if event.get_place_handle():
+                place_handles.append(event.get_place_handle())
+            for cit_handle in event.get_citation_list():
+                citation = self.__get(database, objects, 'citation',
+                                      cit_handle)
+                if citation is not None:
+                    self.__get(database, objects, 'source',
+                               citation.get_reference_handle())
+        for note_handle in person.get_note_list():
+            self.__get(database, objects, 'note', note_handle)
+        while place_handles:
+            place = self.__get(database, objects, 'place',
+                               place_handles.pop())
+            if place is not None:
+                place_handles += [placeref.ref for placeref
+                                  in place.get_placeref_list()]
+        return objects
+
+    def __get(self, database, objects, obj_type, handle):
+        """
+        Read an object into objects, or look up its prefetched record.
+        Return None if the object is cached or read already, or if it is
+        missing, which is left to the rendering thread to report.
+        """
+        records = self.records.get(obj_type)
+        if records is not None:
+            return records.get(handle)
+        key = (obj_type, handle)
+        with self.lock:
+            if key in self.pending or key in self.cache:
+                return None
+            self.pending.add(key)
+        try:
+            obj = getattr(database, 'get_%s_from_handle' % obj_type)(handle)
+        except HandleError:
+            obj = None
+        if obj is None:
+            with self.lock:
+                self.pending.discard(key)
+            return None
+        objects.append((obj_type, handle, obj))
+        return obj
+
+class ChapterWriter(object):
+    """
+    Writer stage of the chapter pipeline: a thread writing the chapters
+    queued by the rendering thread through an output writer.
+    """
+
+    def __init__(self, out, depth):
+        """
+        @param out: the output writer
+        @param depth: number of chapters queued at most
+        """
+        self.out = out
+        self.queue = StageQueue(depth)
+        self.error = None
+        self.thread = threading.Thread(target = self.__run,
+                                       name = 'FamilyBook writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_part(self, name, text):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((name, text))
+
+    def close(self):
+        """
+        Wait for the queued chapters to be written.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def get_stats(self):
+        return self.queue.get_stats()
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            # after an error the rest is dropped, not to block the renderer
+            if self.error is None:
+                try:
+                    self.out.write_part(*item)
+                except Exception as error:
+                    self.error = error
+
+
+#------------------------------------------------------------------------
+#
+# FormatCache
+#
+#------------------------------------------------------------------------
+class FormatCache(object):
+    """
+    Bounded LRU cache of formatted strings (place titles, dates).
+
+    The cached strings depend on display options, which make the context of
+    the cache; setting another context drops all the cached strings.
+    """
+
+    def __init__(self, context, size = _FORMAT_CACHE_SIZE):
+        """
+        @param context: hashable value of the display options in effect
+        @param size: maximum number of cached strings, 0 means unbounded
+        """
+        self.context = context
+        self.size = size
+        self.__strings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def set_context(self, context):
+        """
+        Change the display options, invalidating the cache if they differ.
+        """
+        if context != self.context:
+            self.context = context
+            self.__strings.clear()
+
+    def get(self, key, format_function, *args):
+        """
+        Return the string cached under key, calling format_function(*args)
+        to make it if there is none.
+        """
+        try:
+            text = self.__strings[key]
+        except KeyError:
+            self.misses += 1
+            text = format_function(*args)
+            self.__strings[key] = text
+            if self.size and len(self.__strings) > self.size:
+                self.__strings.popitem(last = False)
+            return text
+        self.hits += 1
+        self.__strings.move_to_end(key)
+        return text
+
+
+#------------------------------------------------------------------------
+#
+# CitationRegistry
+#
+#------------------------------------------------------------------------
+class CitationRegistry(object):
+    """
+    Bibliography entries in the order the citations are first used.
+
+    Every citation is read once and every source once however many
+    citations refer to it; the bibliography item is formatted as soon as
+    its first citation is added. Citations sharing a bibliography key (see
+    FamilyBook.citation_key) share a single entry.
+    """
+
+    def __init__(self, database, make_key, make_item, store = None):
+        """
+        @param database: the database view to read citations and sources from
+        @param make_key: function of (citation, source) returning the
+                         bibliography key
+        @param make_item: function of (key, citation, source) returning the
+                          formatted bibliography item
+        @param store: SpillStore to keep the citation keys and the items in,
+                      None to keep them in memory
+        """
+        self.database = database
+        self.make_key = make_key
+        self.make_item = make_item
+        # sources are few compared to citations
+        self.__sources = {}
+        if store is None:
+            self.__keys = {}
+            self.__items = OrderedDict()
+        else:
+            self.__keys = SpillDict(store, 'citation_key')
+            self.__items = SpillDict(store, 'bibliography_item')
+
+    def __len__(self):
+        return len(self.__items)
+
+    def add(self, cit_handle):
+        """
+        Register a use of the citation.
+        """
+        if cit_handle in self.__keys:
+            return
+        citation = self.database.get_citation_from_handle(cit_handle)
+        src_handle = citation.get_reference_handle()
+        source = self.__sources.get(src_handle)
+        if source is None:
+            source = self.database.get_source_from_handle(src_handle)
+            self.__sources[src_handle] = source
+        key = self.make_key(citation, source)
+        self.__keys[cit_handle] = key
+        if key not in self.__items:
+            self.__items[key] = self.make_item(key, citation, source)
+
+    def get_items(self):
+        """
+        Return the formatted bibliography items in the order of first use.
+        """
+        return self.__items.values()
+
+
+#------------------------------------------------------------------------
+#
+# Prefetched object records
+#
+#------------------------------------------------------------------------
+class EventRecord(object):
+    """
+    Compact read-only stand-in for Event holding the fields used by the
+    report.
+    """
+    __slots__ = ('gramps_id', 'type', 'date', 'place', 'description',
+                 'citation_list')
+
+    def __init__(self, data):
+        self.gramps_id = data[_EVENT_GRAMPS_ID]
+        self.type = data[_EVENT_TYPE]
+        self.date = data[_EVENT_DATE]
+        self.place = data[_EVENT_PLACE]
+        self.description = data[_EVENT_DESCRIPTION]
+        self.citation_list = data[_EVENT_CITATIONS]
+
+    def get_gramps_id(self):
+        return self.gramps_id
+
+    def get_type(self):
+        return EventType(self.type)
+
+    def get_date_object(self):
+        date = Date()
+        if self.date is not None:
+            date.unserialize(self.date)
+        return date
+
+    def get_place_handle(self):
+        return self.place
+
+    def get_description(self):
+        return self.description
+
+    def get_citation_list(self):
+        return self.citation_list
+
+class FamilyRecord(object):
+    """
+    Compact read-only stand-in for Family.
+    """
+    __slots__ = ('gramps_id', 'father_handle', 'mother_handle', 'event_refs')
+
+    def __init__(self, data):
+        self.gramps_id = data[_FAMILY_GRAMPS_ID]
+        self.father_handle = data[_FAMILY_FATHER]
+        self.mother_handle = data[_FAMILY_MOTHER]
+        self.event_refs = data[_FAMILY_EVENT_REFS]
+
+    def get_gramps_id(self):
+        return self.gramps_id
+
+    def get_father_handle(self):
+        return self.father_handle
+
+    def get_mother_handle(self):
+        return self.mother_handle
+
+    def get_event_ref_list(self):
+        return [EventRef().unserialize(data) for data in self.event_refs]
+
+class CitationRecord(object):
+    """
+    Compact read-only stand-in for Citation.
+    """
+    __slots__ = ('gramps_id', 'page', 'source_handle')
+
+    def __init__(self, data):
+        self.gramps_id = data[_CITATION_GRAMPS_ID]
+        self.page = data[_CITATION_PAGE]
+        self.source_handle = data[_CITATION_SOURCE]
+
+    def get_gramps_id(self):
+        return self.gramps_id
+
+    def get_page(self):
+        return self.page
+
+    def get_reference_handle(self):
+        return self.source_handle
+
+class SourceRecord(object):
+    """
+    Compact read-only stand-in for Source.
+    """
+    __slots__ = ('gramps_id', 'title', 'author', 'pubinfo')
+
+    def __init__(self, data):
+        self.gramps_id = data[_SOURCE_GRAMPS_ID]
+        self.title = data[_SOURCE_TITLE]
+        self.author = data[_SOURCE_AUTHOR]
+        self.pubinfo = data[_SOURCE_PUBINFO]
+
+    def get_gramps_id(self):
+        return self.gramps_id
+
+    def get_title(self):
+        return self.title
+
+    def get_author(self):
+        return self.author
+
+    def get_publication_info(self):
+        return self.pubinfo
+
+class NoteRecord(object):
+    """
+    Compact read-only stand-in for Note.
+    """
+    __slots__ = ('gramps_id', 'type', 'text')
+
+    def __init__(self, data):
+        self.gramps_id = data[_NOTE_GRAMPS_ID]
+        self.type = data[_NOTE_TYPE]
+        self.text = data[_NOTE_TEXT]
+
+    def get_gramps_id(self):
+        return self.gramps_id
+
+    def get_type(self):
+        return NoteType(self.type)
+
+    def get(self):
+        return self.text[0]
+
+    def get_styledtext(self):
+        return StyledText().unserialize(self.text)
+
+
+#------------------------------------------------------------------------
+#
+# PrefetchIndex
+#
+#------------------------------------------------------------------------
+class PrefetchIndex(object):
+    """
+    In-memory indexes of the secondary objects used by the report, filled
+    by one sequential scan per table instead of a point lookup per
+    reference.
+
+    Offers the same get_*_from_handle methods as the database but returns
+    compact records. Objects missing from the indexes, as well as every
+    other attribute, are looked up in the wrapped database.
+    """
+
+    TABLES = (('event', EventRecord), ('family', FamilyRecord),
+              ('citation', CitationRecord), ('source', SourceRecord),
+              ('note', NoteRecord))
+
+    def __init__(self, database):
+        """
+        @param database: the Gramps database (or a view of it)
+        """
+        self.database = database
+        self.records = dict((obj_type, {}) for (obj_type, _cls) in self.TABLES)
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    def load(self):
+        """
+        Scan the tables and fill the indexes.
+        """
+        for (obj_type, record_class) in self.TABLES:
+            records = self.records[obj_type]
+            with getattr(self.database, 'get_%s_cursor' % obj_type)() as cursor:
+                for (handle, data) in cursor:
+                    records[handle] = record_class(data)
+
+    def __get(self, obj_type, handle):
+        record = self.records[obj_type].get(handle)
+        if record is None:
+            return getattr(self.database,
+                           'get_%s_from_handle' % obj_type)(handle)
+        return record
+
+    def get_event_from_handle(self, handle):
+        return self.__get('event', handle)
+
+    def get_family_from_handle(self, handle):
+        return self.__get('family', handle)
+
+    def get_citation_from_handle(self, handle):
+        return self.__get('citation', handle)
+
+    def get_source_from_handle(self, handle):
+        return self.__get('source', handle)
+
+    def get_note_from_handle(self, handle):
+        return self.__get('note', handle)
+
+    def get_stats(self):
+        """
+        Return a list of (object type, number of records) tuples.
+        """
+        return [(obj_type, len(self.records[obj_type]))
+                for (obj_type, _cls) in self.TABLES]
+
+
+#------------------------------------------------------------------------
+#
+# PersonIndex
+#
+#------------------------------------------------------------------------
+class PersonIndex(object):
+    """
+    Compact index of the persons of the book.
+
+    Every handle, of a person or of an object referring to one, is kept
+    once and numbered. Person data is kept in parallel lists by the order
+    of addition, back references as flat integer arrays of (person number,
+    class number, handle number). Works as a read-only mapping of person
+    handles to (name, gramps_id, index) tuples.
+    """
+
+    def __init__(self):
+        self.handles = []
+        self.names = []
+        self.gramps_ids = []
+        self.sort_keys = []
+        # handle -> handle number, handle number -> handle and person index
+        self.__numbers = {}
+        self.__all_handles = []
+        self.__positions = array('l')
+        # back references
+        self.__bkref_classes = []
+        self.__bkref_persons = array('l')
+        self.__bkref_class_numbers = array('b')
+        self.__bkref_handles = array('l')
+        self.__bkrefs = None
+
+    def __number(self, handle):
+        number = self.__numbers.get(handle)
+        if number is None:
+            number = len(self.__all_handles)
+            self.__numbers[handle] = number
+            self.__all_handles.append(handle)
+            self.__positions.append(-1)
+        return number
+
+    def __position(self, handle):
+        number = self.__numbers.get(handle)
+        if number is None:
+            return -1
+        return self.__positions[number]
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __contains__(self, handle):
+        return self.__position(handle) >= 0
+
+    def __iter__(self):
+        return iter(self.handles)
+
+    def keys(self):
+        return self.handles
+
+    def __getitem__(self, handle):
+        index = self.__position(handle)
+        if index < 0:
+            raise KeyError(handle)
+        return (self.names[index], self.gramps_ids[index], index)
+
+    def add(self, handle, name, gramps_id, sort_key):
+        """
+        Add a person unless already present.
+
+        @return: the index of the person
+        """
+        number = self.__number(handle)
+        index = self.__positions[number]
+        if index < 0:
+            index = self.__positions[number] = len(self.handles)
+            self.handles.append(handle)
+            self.names.append(name)
+            self.gramps_ids.append(gramps_id)
+            self.sort_keys.append(sort_key)
+        return index
+
+    def get_gramps_id(self, handle):
+        return self[handle][1]
+
+    def get_sorted_handles(self):
+        """
+        Return the person handles ordered by their sort keys.
+        """
+        order = sorted(range(len(self.handles)),
+                       key = self.sort_keys.__getitem__)
+        return [self.handles[index] for index in order]
+
+    def add_back_reference(self, handle, bkref_class, bkref_handle):
+        """
+        Record that the person is referenced by an object.
+        """
+        if bkref_class not in self.__bkref_classes:
+            self.__bkref_classes.append(bkref_class)
+        self.__bkref_persons.append(self.__number(handle))
+        self.__bkref_class_numbers.append(
+            self.__bkref_classes.index(bkref_class))
+        self.__bkref_handles.append(self.__number(bkref_handle))
+        self.__bkrefs = None
+
+    def get_back_references(self, handle):
+        """
+        Return the set of (class, handle, None) back references of a person.
+        """
+        if self.__bkrefs is None:
+            # group the references by person on the first lookup
+            self.__bkrefs = defaultdict(list)
+            for (pos, number) in enumerate(self.__bkref_persons):
+                self.__bkrefs[number].append(pos)
+        number = self.__numbers.get(handle)
+        return set((self.__bkref_classes[self.__bkref_class_numbers[pos]],
+                    self.__all_handles[self.__bkref_handles[pos]], None)
+                   for pos in self.__bkrefs.get(number, ()))
+
+
+#------------------------------------------------------------------------
+#
+# Spill storage
+#
+#------------------------------------------------------------------------
+class SpillStore(object):
+    """
+    Temporary directory holding an SQLite database and sort run files, to
+    keep the bookkeeping of the low memory mode on disk.
+    """
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix = 'familybook-')
+        self.connection = sqlite3.connect(
+            os.path.join(self.directory, 'spill.sqlite'))
+        # the data is thrown away with the directory anyway
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.runs = 0
+
+    def get_run_file(self):
+        """
+        Return the name of a new sort run file.
+        """
+        self.runs += 1
+        return os.path.join(self.directory, 'run%d' % self.runs)
+
+    def close(self):
+        self.connection.close()
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+class ExternalSorter(object):
+    """
+    Sorts more records than fit in memory: every _SPILL_RUN records are
+    sorted and spilled to a run file, and the runs are merged when the
+    records are read.
+    """
+
+    def __init__(self, store):
+        """
+        @param store: SpillStore to spill the runs to
+        """
+        self.store = store
+        self.records = []
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, record):
+        self.records.append(record)
+        self.count += 1
+        if len(self.records) >= _SPILL_RUN:
+            self.__spill()
+
+    def __spill(self):
+        self.records.sort()
+        filename = self.store.get_run_file()
+        with open(filename, 'wb') as run:
+            for i in range(0, len(self.records), _SPILL_BLOCK):
+                pickle.dump(self.records[i:i + _SPILL_BLOCK], run,
+                            pickle.HIGHEST_PROTOCOL)
+        self.runs.append(filename)
+        self.records = []
+
+    def __read_run(self, filename):
+        with open(filename, 'rb') as run:
+            while True:
+                try:
+                    block = pickle.load(run)
+                except EOFError:
+                    break
+                for record in block:
+                    yield record
+
+    def __iter__(self):
+        """
+        Yield the records in order.
+        """
+        self.records.sort()
+        return heapq.merge(iter(self.records),
+                           *[self.__read_run(filename) for filename in self.runs])
+
+class SpillDict(object):
+    """
+    Mapping kept in a table of a SpillStore, iterated in the order of
+    insertion. Values are pickled.
+    """
+
+    def __init__(self, store, name):
+        """
+        @param store: SpillStore to keep the table in
+        @param name: name of the table
+        """
+        self.connection = store.connection
+        self.name = name
+        self.connection.execute('CREATE TABLE %s (key TEXT PRIMARY KEY, '
+                                'value BLOB)' % name)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, key):
+        return self.connection.execute(
+            'SELECT 1 FROM %s WHERE key = ?' % self.name,
+            (key,)).fetchone() is not None
+
+    def __getitem__(self, key):
+        row = self.connection.execute(
+            'SELECT value FROM %s WHERE key = ?' % self.name, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.length += 1
+        self.connection.execute(
+            'INSERT INTO %s VALUES (?, ?) ON CONFLICT (key) '
+            'DO UPDATE SET value = excluded.value' % self.name,
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+
+    def values(self):
+        for (value,) in self.connection.execute(
+                'SELECT value FROM %s ORDER BY rowid' % self.name):
+            yield pickle.loads(value)
+
+class ListDict(defaultdict):
+    """
+    Mapping of keys to lists of values.
+    """
+
+    def __init__(self):
+        defaultdict.__init__(self, list)
+
+    def add(self, key, value):
+        """
+        Append a value to the list of a key.
+        """
+        self[key].append(value)
+
+class SpillListDict(object):
+    """
+    Mapping of keys to lists of values, like ListDict, kept in a table of a
+    SpillStore. Values are pickled.
+    """
+
+    def __init__(self, store, name):
+        """
+        @param store: SpillStore to keep the table in
+        @param name: name of the table
+        """
+        self.connection = store.connection
+        self.name = name
+        self.connection.execute('CREATE TABLE %s (key TEXT, value BLOB)' % name)
+        self.connection.execute('CREATE INDEX %s_key ON %s (key)' % (name, name))
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(DISTINCT key) FROM %s' % self.name).fetchone()[0]
+
+    def __iter__(self):
+        for (key,) in self.connection.execute(
+                'SELECT DISTINCT key FROM %s' % self.name):
+            yield key
+
+    def __getitem__(self, key):
+        return [pickle.loads(value) for (value,) in self.connection.execute(
+            'SELECT value FROM %s WHERE key = ? ORDER BY rowid' % self.name,
+            (key,))]
+
+    def add(self, key, value):
+        """
+        Append a value to the list of a key.
+        """
+        self.connection.execute(
+            'INSERT INTO %s VALUES (?, ?)' % self.name,
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+
+class SpilledPersonIndex(object):
+    """
+    Index of the persons of the book kept in a SpillStore, for the low
+    memory mode. Works like PersonIndex, except that the sorted handles
+    come from an external merge sort.
+    """
+
+    def __init__(self, store):
+        """
+        @param store: SpillStore to keep the index in
+        """
+        self.connection = store.connection
+        self.connection.execute('CREATE TABLE person (handle TEXT PRIMARY KEY, '
+                                'name TEXT, gramps_id TEXT)')
+        self.connection.execute('CREATE TABLE person_bkref (handle TEXT, '
+                                'class INTEGER, bkref_handle TEXT)')
+        self.connection.execute('CREATE INDEX person_bkref_handle '
+                                'ON person_bkref (handle)')
+        self.__bkref_classes = []
+        self.sorter = ExternalSorter(store)
+
+    def __len__(self):
+        return len(self.sorter)
+
+    def __contains__(self, handle):
+        return self.connection.execute(
+            'SELECT 1 FROM person WHERE handle = ?',
+            (handle,)).fetchone() is not None
+
+    def __iter__(self):
+        for (handle,) in self.connection.execute(
+                'SELECT handle FROM person ORDER BY rowid'):
+            yield handle
+
+    def __getitem__(self, handle):
+        row = self.connection.execute(
+            'SELECT name, gramps_id, rowid FROM person WHERE handle = ?',
+            (handle,)).fetchone()
+        if row is None:
+            raise KeyError(handle)
+        # rows are numbered from 1 in the order of addition
+        return (row[0], row[1], row[2] - 1)
+
+    def add(self, handle, name, gramps_id, sort_key):
+        """
+        Add a person unless already present.
+
+        @return: the index of the person
+        """
+        if handle in self:
+            return self[handle][2]
+        cursor = self.connection.execute(
+            'INSERT INTO person VALUES (?, ?, ?)', (handle, name, gramps_id))
+        self.sorter.add((sort_key, handle))
+        return cursor.lastrowid - 1
+
+    def get_gramps_id(self, handle):
+        return self[handle][1]
+
+    def get_sorted_handles(self):
+        """
+        Yield the person handles ordered by their sort keys.
+        """
+        for (sort_key, handle) in self.sorter:
+            yield handle
+
+    def add_back_reference(self, handle, bkref_class, bkref_handle):
+        """
+        Record that the person is referenced by an object.
+        """
+        if bkref_class not in self.__bkref_classes:
+            self.__bkref_classes.append(bkref_class)
+        self.connection.execute(
+            'INSERT INTO person_bkref VALUES (?, ?, ?)',
+            (handle, self.__bkref_classes.index(bkref_class), bkref_handle))
+
+    def get_back_references(self, handle):
+        """
+        Return the set of (class, handle, None) back references of a person.
+        """
+        return set((self.__bkref_classes[number], bkref_handle, None)
+                   for (number, bkref_handle) in self.connection.execute(
+                       'SELECT class, bkref_handle FROM person_bkref '
+                       'WHERE handle = ?', (handle,)))
+
+
+#------------------------------------------------------------------------
+#
+# KinshipIndex
+#
+#------------------------------------------------------------------------
+class KinshipIndex(object):
+    """
+    Parents of the families of the persons of the book, and the names of
+    those parents who have no chapter, so that chapters name the parents
+    and spouses of a person without reading the database.
+    """
+
+    def __init__(self, families = None, names = None):
+        """
+        @param families: mapping to keep the parents of the families in,
+                         a dictionary if None
+        @param names: mapping to keep the names of the relatives in, a
+                      dictionary if None
+        """
+        # family handle -> (father handle, mother handle)
+        self.families = {} if families is None else families
+        # person handle -> display name, of relatives without a chapter
+        self.names = {} if names is None else names
+
+    def __len__(self):
+        return len(self.families)
+
+    def __contains__(self, fam_handle):
+        return fam_handle in self.families
+
+    def add_family(self, fam_handle, father_handle, mother_handle):
+        self.families[fam_handle] = (father_handle, mother_handle)
+
+    def get_parents(self, fam_handle):
+        """
+        Return the (father handle, mother handle) of a family, either may be
+        None.
+        """
+        return self.families.get(fam_handle, (None, None))
+
+    def get_all_parents(self):
+        """
+        Return an iterator over the (father handle, mother handle) of all
+        the families.
+        """
+        return self.families.values()
+
+    def has_name(self, handle):
+        return handle in self.names
+
+    def add_name(self, handle, name):
+        self.names[handle] = name
+
+    def get_name(self, handle):
+        return self.names.get(handle)
+
+
+#------------------------------------------------------------------------
+#
+# RelationshipMap
+#
+#------------------------------------------------------------------------
+class RelationshipMap(object):
+    """
+    Blood relationships of all the persons to the center person, found in
+    one traversal of the raw family graph. Only birth parent-child links
+    are followed.
+
+    The ancestors of the center person are found going up, then a single
+    breadth-first search goes down from all of them at once, ordered by
+    the total number of generations, so that every relative is reached
+    first through its closest common ancestor. For every reached person
+    the numbers of generations from the center person up to the common
+    ancestor and from it down to the person are kept in integer arrays,
+    along with the parent the person was reached from and whether it is
+    the father or the mother, so that the path to the common ancestor can
+    be followed.
+    """
+
+    # codes of the steps of a path up to a father and to a mother
+    ROLE_CODES = (RelationshipCalculator.REL_FATHER,
+                  RelationshipCalculator.REL_MOTHER)
+    FATHER = 0
+    MOTHER = 1
+
+    def __init__(self, database):
+        """
+        @param database: the Gramps database instance
+        """
+        self.database = database
+        self.__numbers = {}
+        # ancestor handle -> path from the center person up to it
+        self.__ancestor_paths = {}
+        self.handles = []
+        self.up = array('h')
+        self.down = array('h')
+        self.parents = array('l')
+        self.roles = array('b')
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __add(self, handle, up, down, parent, role):
+        self.__numbers[handle] = len(self.handles)
+        self.handles.append(handle)
+        self.up.append(up)
+        self.down.append(down)
+        self.parents.append(parent)
+        self.roles.append(role)
+
+    def __role(self, family, parent):
+        """
+        Return the role of a parent in a raw family.
+        """
+        if parent == family[_FAMILY_FATHER]:
+            return self.FATHER
+        return self.MOTHER
+
+    def build(self, center_handle, persons = None, max_generations = None):
+        """
+        Find the relationships to the center person.
+
+        @param center_handle: handle of the center person
+        @param persons: if given, the handles of the persons within the
+                        scope of the book; the search does not go through
+                        other persons
+        @param max_generations: if given, the largest number of generations
+                                up and down between the center person and
+                                a relative
+        """
+        families = {}
+        def get_family(fam_handle):
+            if fam_handle not in families:
+                families[fam_handle] = self.database.get_raw_family_data(fam_handle)
+            return families[fam_handle]
+
+        # ancestors with their shortest distance up
+        ancestors = OrderedDict([(center_handle, 0)])
+        paths = self.__ancestor_paths
+        paths[center_handle] = ''
+        queue = deque([center_handle])
+        while queue:
+            handle = queue.popleft()
+            data = self.database.get_raw_person_data(handle)
+            if not data:
+                continue
+            up = ancestors[handle] + 1
+            if max_generations is not None and up > max_generations:
+                continue
+            for fam_handle in data[_PERSON_PARENT_FAMILIES]:
+                family = get_family(fam_handle)
+                if not family:
+                    continue
+                for child_ref in family[_FAMILY_CHILDREN]:
+                    if child_ref[_CHILD_REF_REF] == handle:
+                        for parent in _birth_parents(family, child_ref):
+                            if parent in ancestors or (
+                                    persons is not None and
+                                    parent not in persons):
+                                continue
+                            ancestors[parent] = up
+                            paths[parent] = paths[handle] + self.ROLE_CODES[
+                                self.__role(family, parent)]
+                            queue.append(parent)
+
+        # down from all the ancestors, by the number of generations between
+        # the center person and the relative; an ancestor is its own common
+        # ancestor
+        levels = defaultdict(list)
+        for (handle, up) in ancestors.items():
+            levels[up].append((handle, up, 0, None, self.FATHER))
+        level = 0
+        while level in levels and (max_generations is None or
+                                   level <= max_generations):
+            for (handle, up, down, parent, role) in levels.pop(level):
+                if handle in self.__numbers:
+                    continue
+                if persons is not None and handle not in persons:
+                    continue
+                data = self.database.get_raw_person_data(handle)
+                if not data:
+                    continue
+                self.__add(handle, up, down,
+                           -1 if parent is None else self.__numbers[parent],
+                           role)
+                for fam_handle in data[_PERSON_FAMILIES]:
+                    family = get_family(fam_handle)
+                    if not family:
+                        continue
+                    for child_ref in family[_FAMILY_CHILDREN]:
+                        child = child_ref[_CHILD_REF_REF]
+                        if (child not in self.__numbers and
+                                handle in _birth_parents(family, child_ref)):
+                            levels[level + 1].append((
+                                child, up, down + 1, handle,
+                                self.__role(family, handle)))
+            level += 1
+
+    def get(self, handle):
+        """
+        Return (generations up, generations down) between the center
+        person and the person, None if the person is not a blood relative.
+        """
+        number = self.__numbers.get(handle)
+        if number is None:
+            return None
+        return (self.up[number], self.down[number])
+
+    def get_path(self, handle):
+        """
+        Return the handles of the persons from the person up to its common
+        ancestor with the center person.
+        """
+        path = []
+        number = self.__numbers.get(handle, -1)
+        while number >= 0:
+            path.append(self.handles[number])
+            number = self.parents[number]
+        return path
+
+    def get_role_paths(self, handle):
+        """
+        Return the paths from the center person and from the person up to
+        their common ancestor, as strings of the father and mother codes of
+        the relationship calculators (e.g. 'mf' for a mother's father);
+        None if the person is not a blood relative.
+        """
+        number = self.__numbers.get(handle)
+        if number is None:
+            return None
+        codes = []
+        while self.parents[number] >= 0:
+            codes.append(self.ROLE_CODES[self.roles[number]])
+            number = self.parents[number]
+        return (self.__ancestor_paths[self.handles[number]], ''.join(codes))
+
+
+#------------------------------------------------------------------------
+#
+# DatabaseSnapshot
+#
+#------------------------------------------------------------------------
+class DatabaseSnapshot(object):
+    """
+    In-memory copy of the person, family and event tables shared by the
+    books of a batch.
+
+    Raw data of the copied tables is served from memory, their objects are
+    built from it. Other tables, as well as every other attribute, are
+    read from the wrapped database.
+    """
+
+    TABLES = (('person', Person), ('family', Family), ('event', Event))
+
+    def __init__(self, database):
+        """
+        @param database: the Gramps database instance
+        """
+        self.database = database
+        self.tables = dict((obj_type, {}) for (obj_type, _cls) in self.TABLES)
+        self.person_ids = {}
+        for (obj_type, obj_class) in self.TABLES:
+            self.__add_accessors(obj_type, obj_class)
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    def __add_accessors(self, obj_type, obj_class):
+        # the tables may be shared with a reopened snapshot
+        def get_raw_data(handle):
+            return self.tables[obj_type].get(handle)
+
+        def get_from_handle(handle):
+            data = self.tables[obj_type].get(handle)
+            if data is None:
+                return getattr(self.database,
+                               'get_%s_from_handle' % obj_type)(handle)
+            return obj_class().unserialize(data)
+
+        @contextmanager
+        def get_cursor():
+            yield iter(self.tables[obj_type].items())
+
+        setattr(self, 'get_raw_%s_data' % obj_type, get_raw_data)
+        setattr(self, 'get_%s_from_handle' % obj_type, get_from_handle)
+        setattr(self, 'get_%s_cursor' % obj_type, get_cursor)
+
+    def load(self):
+        """
+        Scan the tables into memory.
+        """
+        for (obj_type, _cls) in self.TABLES:
+            table = self.tables[obj_type]
+            with getattr(self.database, 'get_%s_cursor' % obj_type)() as cursor:
+                for (handle, data) in cursor:
+                    table[handle] = data
+        self.person_ids = dict((data[_PERSON_GRAMPS_ID], handle) for
+                               (handle, data) in self.tables['person'].items())
+
+    def reopen(self):
+        """
+        Return a snapshot sharing the tables of this one in front of a
+        private connection to the family tree, or this one if the database
+        cannot be reopened.
+        """
+        database = _open_database_copy(self.database)
+        if database is self.database:
+            return self
+        snapshot = DatabaseSnapshot(database)
+        snapshot.tables = self.tables
+        snapshot.person_ids = self.person_ids
+        return snapshot
+
+    def get_person_from_gramps_id(self, gramps_id):
+        handle = self.person_ids.get(gramps_id)
+        if handle is None:
+            return None
+        return self.get_person_from_handle(handle)
+
+
+class _BookOptions(object):
+    """
+    Options of a book of a batch: the options of the batch report, except
+    that the document, opened by the batch report, is not opened again.
+    The book is still written into its LaTeX files as a standalone report.
+    """
+
+    def __init__(self, options_class):
+        self.options_class = options_class
+
+    def __getattr__(self, name):
+        return getattr(self.options_class, name)
+
+    def get_output(self):
+        return None
 
 
 #------------------------------------------------------------------------
@@ -53,6 +2584,18 @@ empty_marriage.set_type(EventType.MARRIAGE)
 #
 #------------------------------------------------------------------------
 class FamilyBook(Report):
+
+    # events listed in the gazetteer, in the order of listing
+    PLACE_EVENT_TYPES = (EventType.BIRTH, EventType.MARRIAGE,
+                         EventType.DEATH, EventType.BURIAL)
+
+    # options changing how the book is made, but not its content
+    PERFORMANCE_OPTIONS = frozenset(('cache_size', 'prefetch', 'jobs',
+                                     'pipeline_depth', 'streaming',
+                                     'chapter_cache', 'tex_file',
+                                     'batch_pids', 'instrument',
+                                     'profile_chapters', 'skip_unchanged'))
+
     def __init__(self, database, options, user):
         """
         Initialize the report.
@@ -63,15 +2606,139 @@ class FamilyBook(Report):
         """
 
         Report.__init__(self, database, options, user)
+        if isinstance(options, _BookOptions):
+            # a book of a batch has no document of its own
+            self.standalone = True
         self.user = user
+        # set by cancel(), an interrupt or the cancel button of the progress
+        # dialog to stop at a chapter boundary
+        self.cancel_event = threading.Event()
         menu = options.menu
-        self.citation_handles = set()
+        self.citations = None
+        self.chapter_citations = []
+        self.chapter_places = []
+        # place handle -> list of (person handle, event type, date sort
+        # value, date text) of the events of the book at the place
+        self.place_events = ListDict()
+        # keeps the bookkeeping on disk in the low memory mode
+        self.streaming = menu.get_option_by_name('streaming').get_value()
+        self.spill = None
+        self.merge_citations = menu.get_option_by_name(
+            'merge_citations').get_value()
 
         self.set_locale(options.menu.get_option_by_name('trans').get_value())
+        try:
+            # the strings of the book, in the language of the report
+            self._ = self._locale.get_addon_translator(__file__).sgettext
+        except ValueError:
+            pass
         stdoptions.run_date_format_option(self, menu)
         self.rlocale = self._locale
+        # gazetteer headings of the events at a place
+        self.place_event_titles = {
+            EventType.BIRTH: self._("Births"),
+            EventType.MARRIAGE: self._("Marriages"),
+            EventType.DEATH: self._("Deaths"),
+            EventType.BURIAL: self._("Burials")}
+        # abbreviation before a page reference
+        self.page_abbrev = self._("p.")
         
         self.person_id    = menu.get_option_by_name('pid').get_value()
+        self.relationships = None
+        self.rel_calc = None
+        if menu.get_option_by_name('relationships').get_value():
+            self.rel_calc = get_relationship_calculator(reinit = True,
+                                                        clocale = self.rlocale)
+        # (generations up, generations down, gender, path from the center
+        # person, path from the person) -> relationship title
+        self.__relationship_titles = {}
+        self.scope = menu.get_option_by_name('scope').get_value()
+        self.scope_steps = menu.get_option_by_name('scope_steps').get_value()
+
+        # display helpers are called through attributes to be instrumented
+        self._display_name = displayer.display_name
+        self._display_event = place_displayer.display_event
+        self._get_date = self.rlocale.get_date
+        self.instrumentation = None
+        self.profile_chapters = False
+        if menu.get_option_by_name('instrument').get_value():
+            self.instrumentation = Instrumentation()
+            self.profile_chapters = menu.get_option_by_name(
+                'profile_chapters').get_value()
+            self.database = InstrumentedDatabase(database, self.instrumentation)
+            wrap = self.instrumentation.wrap
+            self._display_name = wrap('display_name', self._display_name)
+            self._display_event = wrap('display_event', self._display_event)
+            self._get_date = wrap('get_date', self._get_date)
+
+        # place titles depend on the event date as places may be renamed
+        self.place_titles = FormatCache(self.__format_context())
+        self.date_strings = FormatCache(self.__format_context())
+        # place handle -> whether its title depends on the date
+        self.__dated_places = {}
+
+        # all object reads of the report go through this view of the database
+        cache_size = menu.get_option_by_name('cache_size').get_value()
+        if self.streaming and not 0 < cache_size < _SPILL_CACHE_SIZE:
+            cache_size = _SPILL_CACHE_SIZE
+        self.db = ObjectCache(self.database, cache_size)
+        self.prefetch = menu.get_option_by_name('prefetch').get_value()
+        self.jobs = menu.get_option_by_name('jobs').get_value()
+        # chapters read ahead and queued for writing by the pipeline threads
+        self.pipeline_depth = menu.get_option_by_name(
+            'pipeline_depth').get_value()
+        # pipeline stage name -> queue statistics
+        self.pipeline_stats = OrderedDict()
+        self.tex_file = menu.get_option_by_name('tex_file').get_value()
+        self.split_chapters = menu.get_option_by_name('split_chapters').get_value()
+        # a batch writes its books directly into LaTeX files only
+        self.batch_ids = []
+        if self.tex_file and self.standalone:
+            self.batch_ids = [person_id for person_id in re.split(
+                r'[\s,;]+', menu.get_option_by_name('batch_pids').get_value())
+                if person_id]
+        self.chapter_cache = None
+        cache_file = menu.get_option_by_name('chapter_cache').get_value()
+        if cache_file and not self.batch_ids:
+            self.chapter_cache = ChapterCache(cache_file)
+        self.skip_unchanged = menu.get_option_by_name(
+            'skip_unchanged').get_value()
+        if self.chapter_cache is not None or self.skip_unchanged:
+            # chapters depend on the report code and display options as well
+            with open(__file__, 'rb') as source:
+                self.__options_key = hashlib.sha1(source.read()).hexdigest()
+            for name in ('name_format', 'date_format', 'trans',
+                         'merge_citations', 'pid', 'relationships',
+                         'photo_dir'):
+                self.__options_key += ':' + str(
+                    menu.get_option_by_name(name).get_value())
+            # and the whole book on the options deciding its content
+            self.__book_key = self.__options_key + ''.join(
+                '\n%s=%s' % (name, menu.get_option_by_name(name).get_value())
+                for name in sorted(menu.get_all_option_names())
+                if name not in self.PERFORMANCE_OPTIONS)
+        self.photos = None
+        photo_dir = menu.get_option_by_name('photo_dir').get_value()
+        if photo_dir and Image is None:
+            self.user.warn(_("The portraits are left out"),
+                           _("The Python imaging library (Pillow) needed "
+                             "to scale the portraits is not installed."))
+        elif photo_dir and not self.batch_ids:
+            self.photos = ThumbnailCache(photo_dir, (
+                int(round(_PHOTO_WIDTH * _PHOTO_DPI / 25.4)),
+                int(round(_PHOTO_HEIGHT * _PHOTO_DPI / 25.4))))
+            # thumbnails are included relative to the LaTeX file
+            if self.tex_file and self.standalone:
+                photo_dir = os.path.relpath(
+                    photo_dir, os.path.dirname(os.path.abspath(self.tex_file)))
+            else:
+                photo_dir = os.path.abspath(photo_dir)
+            self.photo_prefix = photo_dir.replace(os.sep, '/') + '/'
+        # (surname, given name, person index, primary surname if an
+        # alternate name or None) of every name of the persons of the book
+        self.name_index = None
+        if menu.get_option_by_name('name_index').get_value():
+            self.name_index = []
         self.document_class = 'memoir'
         self.styleName = 'default'
         self.language = 'russian'
@@ -80,144 +2747,1063 @@ class FamilyBook(Report):
         """
         Build the actual report.
         """
+        if self.batch_ids:
+            self._write_batch()
+            return
+
+        # the date displayer is shared, its format may have been changed
+        # since the report was created
+        for cache in (self.place_titles, self.date_strings):
+            cache.set_context(self.__format_context())
 
         mark1 = docgen.IndexMark(_('Family Book'), docgen.INDEX_TYPE_TOC, 1)
         self.doc.start_paragraph('FSR-Key')
         self.doc.write_text('', mark1) # for use in a TOC in a book report
         self.doc.end_paragraph()
 
-        self.doc.start_paragraph('FSR-Normal')
-        self.doc.write_text('\\documentclass[11pt, msmallroyalvopaper, openany]{')
-        self.doc.write_text(self.document_class)
-        self.doc.write_text('}\n')
-        self.doc.write_text('\\usepackage[utf8]{inputenc}\n')
-        self.doc.write_text('\\usepackage[')
-        self.doc.write_text(self.language)
-        self.doc.write_text(']{babel}\n')
-        self.doc.write_text('\\usepackage{caption}\n')
-        self.doc.write_text('\\usepackage{graphicx}\n')
-        self.doc.write_text('\\usepackage{wrapfig}\n')
-        self.doc.write_text('\\usepackage{multicol}\n')
-        self.doc.write_text('\\usepackage[superscript,biblabel]{cite}\n')
-        self.doc.write_text('\\setcounter{secnumdepth}{-1}\n')
-        
-        self.doc.write_text('\n% styling\n')
-        self.doc.write_text('\\tightlists\n')
-        self.doc.write_text('\\usepackage{calc}\n')
-        self.doc.write_text('\\usepackage{enumitem}\n')
-        self.doc.write_text('\\usepackage{pgfornament}\n')
-        self.doc.write_text('\\chapterstyle{bringhurst}\n')
-        self.doc.write_text('\\definecolor{steelgrey}{rgb}{0.62, 0.62, 0.62}\n')
-        self.doc.write_text('\\newcommand*{\\sclabel}[1]{\\normalfont\\scshape #1}\n')
-        self.doc.write_text('\\newcommand{\\fbNoteSeparator}{\\begin{center}\\noindent\\pgfornament[width=2em,color=steelgrey]{94}\\medskip\end{center}}\n')
-        self.doc.write_text('\\newcommand{\\fbBeginPersonDescription}{\\begin{description}[before=\\renewcommand{\\makelabel}{\\sclabel},leftmargin=!,labelwidth=\\widthof{\\sclabel{Похоронена}}]}\n')
-        self.doc.write_text('\\newcommand{\\fbEndPersonDescription}{\\end{description}}\n')
-#        self.doc.write_text('\\newcommand{\\fbBeginPersonDescription}{\\begin{flexlabelled}{sclabel}{2em}{1.0em}{1.0em}{2em}{0pt}}\n')
-#        self.doc.write_text('\\newcommand{\\fbEndPersonDescription}{\\end{flexlabelled}}\n')
-        self.doc.write_text('\\newcommand{\\fbPersonDescriptionItem}[2]{\\item[#1] #2}\n')
-        self.doc.write_text('% end of styling\n\n')
-        
-        self.doc.write_text('\\begin{document}\n')
-        self.doc.write_text('\\tableofcontents\n')
-        self.doc.write_text('\\part{Персоналии}\n')
-        self.doc.end_paragraph()
+        # a book written directly into LaTeX files is skipped if unchanged
+        digest_file = None
+        if self.skip_unchanged and self.tex_file and self.standalone:
+            digest_file = os.path.splitext(self.tex_file)[0] + '.digest'
+        digest = None
 
-        self._build_obj_dict()
+        self.out = None
+        profiler = None
+        try:
+            if self.streaming:
+                self.spill = SpillStore()
+                self.place_events = SpillListDict(self.spill, 'place_event')
+            if self.prefetch:
+                with self.__phase('prefetch'):
+                    self.db = PrefetchIndex(self.db)
+                    self.db.load()
 
-#        person = self.database.get_person_from_gramps_id(self.person_id)
-#        (rank, ahnentafel, person_key) = self.__calc_person_key(person)
-#        self.__process_person(person)
+            with self.__phase('build'):
+                self._build_obj_dict()
+            # checked before the relationships and the portraits are made
+            if digest_file is not None:
+                with self.__phase('digest'):
+                    digest = self._book_digest()
+                # the thumbnails are made again if they were removed
+                if (digest == self.__read_digest(digest_file) and
+                        os.path.isfile(self.tex_file) and
+                        (self.photos is None or
+                         os.path.isfile(self.photos.index_file))):
+                    self.user.info(_("The book is up to date"),
+                                   _("Nothing %s is made from has changed, "
+                                     "it was not written again.")
+                                   % self.tex_file)
+                    return
+                # written again once the book is complete
+                if os.path.isfile(digest_file):
+                    os.remove(digest_file)
+            if self.rel_calc is not None:
+                with self.__phase('relationships'):
+                    self._build_relationships()
+            self.scope_handles = None
+            if self.photos is not None:
+                with self.__phase('photos'):
+                    self._make_photos()
+            self.__open_output()
 
-        person_list = list(self.obj_dict[Person].keys())
-        person_list.sort(key = lambda x: self.obj_dict[Person][x][0])
-        for person_handle in person_list:
-            person = self.database.get_person_from_handle(person_handle)
-            self.__process_person(person)
+#            person = self.database.get_person_from_gramps_id(self.person_id)
+#            (rank, ahnentafel, person_key) = self.__calc_person_key(person)
+#            self.__process_person(person)
 
-        self.doc.start_paragraph('FSR-Normal')
-        self.doc.write_text('\\part{Места}\n')
-        self.doc.end_paragraph()
-            
-        self.doc.start_paragraph('FSR-Normal')
-        self.doc.write_text('\\begin{thebibliography}{99}\n')
-        self.doc.write_text('\\scriptsize\n')
-        for cit_handle in self.citation_handles:
-            self.doc.write_text(self.__make_bib_item(cit_handle))
-        self.doc.write_text('\\end{thebibliography}\n')
-        self.doc.write_text('\\end{document}\n')
-        self.doc.end_paragraph()
+            with self.__phase('sort'):
+                person_list = self._sort_persons()
+            self.citations = CitationRegistry(self.db, self.citation_key,
+                                              self.__make_bib_item, self.spill)
+            with self.__phase('chapters'):
+                if self.profile_chapters:
+                    profiler = cProfile.Profile()
+                    profiler.enable()
+                try:
+                    with self.__cancel_on_interrupt():
+                        self._write_chapters(person_list)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
 
-    def __make_bib_item(self, cit_handle):
-        cit = self.database.get_citation_from_handle(cit_handle)
-        src_handle = cit.get_reference_handle()
-        src = self.database.get_source_from_handle(src_handle)
-        s = '\\bibitem{'
-        s = s + cit.get_gramps_id()
-        s = s + '} '
-        s = s + src.get_title()
-        if not s.endswith('.'):
-            s = s + '.'
-        if src.get_author() != '':
-            a = src.get_author()
-            if not a.endswith('.'):
-                a = a + '.'
-            s = s + ' {\\itshape '
-            s = s + a
-            s = s + '}'
-        if src.get_publication_info() != '':
-            pub = ' '
-            pub = pub + src.get_publication_info()
-            if not pub.endswith('.'):
-                pub = pub + '.'
-            s = s + pub
-        s = s + '~// '
-        s = s + cit.get_page()
-        if not s.endswith('.'):
-            s = s + '.'
-        s = s + '\n'
-        return s
+            self.out.write('\\part{Места}\n')
+            with self.__phase('places'):
+                self._write_places()
+            with self.__phase('bibliography'):
+                self._write_bibliography()
+            if self.name_index:
+                self.out.write('\\part{' + self._("Index of names") + '}\n')
+                with self.__phase('name_index'):
+                    self._write_name_index()
+            self.out.write('\\end{document}\n')
+        except:
+            if self.out is not None:
+                self.out.abort()
+            raise
+        else:
+            with self.__phase('close'):
+                self.out.close()
+            if digest is not None:
+                with io.open(digest_file, 'w', encoding = 'utf-8') as output:
+                    output.write(digest + '\n')
+        finally:
+            # keeps the chapters rendered before a cancellation
+            if self.chapter_cache is not None:
+                self.chapter_cache.close()
+            if self.spill is not None:
+                self.spill.close()
+        if self.instrumentation is not None:
+            self.__report_stats()
+            self.__write_instrumentation(profiler)
+        else:
+            self.__report_summary()
+
+    def __open_output(self):
+        """
+        Open the output writer and write the preamble.
+        """
+        if self.tex_file and self.standalone and self.split_chapters:
+            self.out = SplitTexWriter(self.tex_file)
+        elif self.tex_file and self.standalone:
+            self.out = TexWriter(self.tex_file)
+        else:
+            self.out = DocWriter(self.doc)
+        if self.instrumentation is not None:
+            self.out.write = self.instrumentation.wrap('output', self.out.write)
+            self.out.write_part = self.instrumentation.wrap('output',
+                                                            self.out.write_part)
+        self.out.write(self.__make_preamble())
+
+    def _book_digest(self):
+        """
+        Return the digest of everything the book is made from: the chapter
+        signatures of the persons, i.e. the change times of the persons
+        and of the objects they refer to, combined regardless of the order
+        of the persons, the portrait images and the options.
+
+        It is computed before the relationships are found and the portraits
+        are scaled. The relationships follow from the families of the
+        persons, which are in the signatures; the portraits are told by
+        their image files.
+        """
+        persons = self.obj_dict[Person]
+        combined = 0
+        with Progress(self.user, _("Checking for changes"),
+                      len(persons)) as progress:
+            for handle in persons:
+                combined ^= int(self.__chapter_signature(handle), 16)
+                progress.step()
+        photos = None
+        if self.photos is not None:
+            photos = self.photos.get_signature()
+        return hashlib.sha1(('%s\n%d\n%040x\n%s' % (
+            self.__book_key, len(persons), combined, photos)).encode('utf-8')
+            ).hexdigest()
+
+    def __read_digest(self, filename):
+        """
+        Return the digest stored by the previous run, None if there is none.
+        """
+        if not os.path.isfile(filename):
+            return None
+        with io.open(filename, encoding = 'utf-8') as digest:
+            return digest.read().strip()
+
+    def _write_batch(self):
+        """
+        Write a book per center person of the batch from one snapshot of
+        the database, in parallel if several jobs are allowed.
+        """
+        snapshot = DatabaseSnapshot(self.database)
+        snapshot.load()
+        if (self.jobs > 1 and len(self.batch_ids) > 1 and
+                'fork' in multiprocessing.get_all_start_methods()):
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers = self.jobs,
+                                     mp_context = context,
+                                     initializer = _init_book_worker,
+                                     initargs = (self, snapshot)) as executor:
+                # consume the results to raise the errors of the workers
+                list(executor.map(_write_book, self.batch_ids))
+        else:
+            for person_id in self.batch_ids:
+                if self.cancel_event.is_set():
+                    raise ReportError(_("The report was cancelled"))
+                self._write_book(snapshot, person_id)
+
+    def _write_book(self, snapshot, person_id, jobs = None):
+        """
+        Write the book of a center person of the batch, exactly like the
+        report with the person ID appended to the output files would.
+
+        @param snapshot: DatabaseSnapshot to read from
+        @param person_id: Gramps ID of the center person
+        @param jobs: number of chapter rendering processes, the option
+                     value if None
+        """
+        menu = self.options_class.menu
+        values = {'pid': person_id, 'batch_pids': '',
+                  'tex_file': _batch_file_name(self.tex_file, person_id)}
+        cache_file = menu.get_option_by_name('chapter_cache').get_value()
+        if cache_file:
+            values['chapter_cache'] = _batch_file_name(cache_file, person_id)
+        # options are read when a report is created
+        saved = {}
+        for (name, value) in values.items():
+            option = menu.get_option_by_name(name)
+            saved[name] = option.get_value()
+            option.set_value(value)
+        try:
+            book = FamilyBook(snapshot, _BookOptions(self.options_class),
+                              self.user)
+        finally:
+            for (name, value) in saved.items():
+                menu.get_option_by_name(name).set_value(value)
+        book.cancel_event = self.cancel_event
+        if jobs is not None:
+            book.jobs = jobs
+        book.write_report()
+
+    def cancel(self):
+        """
+        Ask the report to stop at the next chapter boundary; may be called
+        from another thread.
+        """
+        self.cancel_event.set()
+
+    @contextmanager
+    def __cancel_on_interrupt(self):
+        """
+        Context manager turning the first interrupt (Ctrl+C) into a
+        cancellation of the report, a second one interrupts as usual.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        def interrupt(signum, frame):
+            if self.cancel_event.is_set():
+                raise KeyboardInterrupt
+            self.cancel_event.set()
+        previous = signal.signal(signal.SIGINT, interrupt)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGINT, previous)
+
+    def __phase(self, name):
+        """
+        Return a context manager timing a report phase if instrumented.
+        """
+        if self.instrumentation is None:
+            return _no_phase()
+        return self.instrumentation.phase(name)
+
+    def __write_instrumentation(self, profiler):
+        """
+        Write the performance statistics as JSON next to the report output
+        (to stderr if there is no output file, i.e. in a book), and the
+        chapter profile into a .prof file for pstats.
+        """
+        summary = self.instrumentation.summary()
+        summary['jobs'] = self.jobs
+        summary['chapters'] = len(self.obj_dict[Person])
+        if self.pipeline_stats:
+            summary['pipeline'] = self.pipeline_stats
+        output = self.tex_file or self.options_class.get_output()
+        base = os.path.splitext(output)[0] if output else None
+        if profiler is not None:
+            stats = pstats.Stats(profiler)
+            functions = sorted(stats.stats.items(),
+                               key = lambda item: -item[1][3])
+            summary['profile'] = [
+                {'function': '%s:%d(%s)' % key, 'calls': calls,
+                 'total': round(total, 6), 'cumulative': round(cumulative, 6)}
+                for (key, (prim_calls, calls, total, cumulative, callers))
+                in functions[:_PROFILED_FUNCTIONS]]
+            if base:
+                profiler.dump_stats(base + '.prof')
+        if base:
+            with io.open(base + '.profile.json', 'w', encoding = 'utf-8') as out:
+                json.dump(summary, out, indent = 1, ensure_ascii = False)
+        else:
+            json.dump(summary, sys.stderr, indent = 1, ensure_ascii = False)
+
+    def _sort_persons(self):
+        """
+        Return the handles of the persons of the book in chapter order.
+        """
+        return self.obj_dict[Person].get_sorted_handles()
+
+    def _write_chapters(self, person_list):
+        """
+        Render and write the chapters of the persons.
+        """
+        total = len(self.obj_dict[Person])
+        # the person list may be an iterator, read ahead by the renderers
+        (person_list, handles) = tee(person_list)
+        if self.chapter_cache is None:
+            chapters = self.__render_chapters(person_list)
+        else:
+            chapters = self.__render_chapters_cached(person_list)
+        out = self.out
+        if self.pipeline_depth:
+            out = ChapterWriter(self.out, self.pipeline_depth)
+        try:
+            with Progress(self.user, _("Writing chapters"), total,
+                          self.cancel_event) as progress:
+                for (count, (person_handle, (text, citations, places))) in \
+                        enumerate(zip(handles, chapters), 1):
+                    # add in the order of use, as the serial run would
+                    for cit_handle in citations:
+                        self.citations.add(cit_handle)
+                    for (place_handle, event_type, sortval, date) in places:
+                        self.place_events.add(place_handle, (
+                            person_handle, event_type, sortval, date))
+                    out.write_part(
+                        self.obj_dict[Person].get_gramps_id(person_handle),
+                        text)
+                    progress.step()
+                    if self.cancel_event.is_set():
+                        raise ReportError(
+                            _("The report was cancelled"),
+                            _("%(count)d of %(total)d chapters were written")
+                            % {'count': count, 'total': total})
+        finally:
+            # stop the chapters being rendered ahead
+            chapters.close()
+            if out is not self.out:
+                out.close()
+                self.pipeline_stats['write'] = out.get_stats()
+
+    def _make_photos(self):
+        """
+        Make the missing thumbnails of the portraits of the book.
+        """
+        with Progress(self.user, _("Scaling portraits"),
+                      len(self.photos)) as progress:
+            for filename in self.photos.make(self.jobs):
+                progress.step()
+
+    def _write_places(self):
+        """
+        Write the gazetteer of the places of the events of the book.
+        """
+        if self.place_events:
+            self.out.begin_part('places')
+            self.__write_places()
+            self.out.end_part()
+
+    def _write_bibliography(self):
+        """
+        Write the bibliography of the cited citations.
+        """
+        self.out.begin_part('bibliography')
+        self.__write_bibliography()
+        self.out.end_part()
+
+    def _write_name_index(self):
+        """
+        Write the index of the names of the persons of the book.
+        """
+        self.out.begin_part('names')
+        self.__write_name_index()
+        self.out.end_part()
+
+    def __make_preamble(self):
+        """
+        Return the LaTeX preamble and the beginning of the document.
+        """
+        out = []
+        out.append('\\documentclass[11pt, msmallroyalvopaper, openany]{')
+        out.append(self.document_class)
+        out.append('}\n')
+        out.append('\\usepackage[utf8]{inputenc}\n')
+        out.append('\\usepackage[')
+        out.append(self.language)
+        out.append(']{babel}\n')
+        out.append('\\usepackage{caption}\n')
+        out.append('\\usepackage{graphicx}\n')
+        out.append('\\usepackage{wrapfig}\n')
+        out.append('\\usepackage{multicol}\n')
+        out.append('\\usepackage[superscript,biblabel]{cite}\n')
+        out.append('\\usepackage[normalem]{ulem}\n')
+        out.append('\\setcounter{secnumdepth}{-1}\n')
         
-    def _build_obj_dict(self):
-        _obj_class_list = (Person, Place)
+        out.append('\n% styling\n')
+        out.append('\\tightlists\n')
+        out.append('\\usepackage{calc}\n')
+        out.append('\\usepackage{enumitem}\n')
+        out.append('\\usepackage{pgfornament}\n')
+        out.append('\\chapterstyle{bringhurst}\n')
+        out.append('\\definecolor{steelgrey}{rgb}{0.62, 0.62, 0.62}\n')
+        out.append('\\newcommand*{\\sclabel}[1]{\\normalfont\\scshape #1}\n')
+        out.append('\\newcommand{\\fbNoteSeparator}{\\begin{center}\\noindent\\pgfornament[width=2em,color=steelgrey]{94}\\medskip\end{center}}\n')
+        out.append('\\newcommand{\\fbBeginPersonDescription}{\\begin{description}[before=\\renewcommand{\\makelabel}{\\sclabel},leftmargin=!,labelwidth=\\widthof{\\sclabel{Похоронена}}]}\n')
+        out.append('\\newcommand{\\fbEndPersonDescription}{\\end{description}}\n')
+#        out.append('\\newcommand{\\fbBeginPersonDescription}{\\begin{flexlabelled}{sclabel}{2em}{1.0em}{1.0em}{2em}{0pt}}\n')
+#        out.append('\\newcommand{\\fbEndPersonDescription}{\\end{flexlabelled}}\n')
+        out.append('\\newcommand{\\fbPersonDescriptionItem}[2]{\\item[#1] #2}\n')
+        out.append('\\newcommand{\\fbNameIndexSurname}[1]{\\par\\medskip\\noindent\\textbf{#1}\\par\\nopagebreak}\n')
+        out.append('\\newcommand{\\fbNameIndexEntry}[2]{\\par\\noindent\\hangindent=1em #1, %s~\\pageref{#2}}\n'
+                   % self.page_abbrev)
+        out.append('\\newcommand{\\fbPortrait}[1]{\\begin{center}\\includegraphics[width=%dmm,height=%dmm]{#1}\\end{center}}\n'
+                   % (_PHOTO_WIDTH, _PHOTO_HEIGHT))
+        out.append('% end of styling\n\n')
+
+        # for the links of the notes, after all the packages it redefines
+        out.append('\\usepackage[unicode,hidelinks]{hyperref}\n\n')
+        out.append('\\begin{document}\n')
+        out.append('\\tableofcontents\n')
+        out.append('\\part{Персоналии}\n')
+        return ''.join(out)
+
+    def __write_places(self):
+        """
+        Write the gazetteer: a section per place, in the order of the place
+        hierarchy, listing the events of the book at the place with page
+        references to the chapters of the persons. Every section is written
+        as soon as it is made.
+        """
+        persons = self.obj_dict[Person]
+        with Progress(self.user, _("Writing places"),
+                      len(self.place_events)) as progress:
+            for place_handle in self.__sort_places(self.place_events):
+                out = []
+                self.__add_place_section(out, persons, place_handle)
+                self.out.write(''.join(out))
+                progress.step()
+
+    def __add_place_section(self, out, persons, place_handle):
+        """
+        Add the gazetteer section of a place.
+        """
+        place = self.db.get_place_from_handle(place_handle)
+        out += ['\\section{', place_displayer.display(self.db, place),
+                '}\n', '\\fbBeginPersonDescription\n']
+        events = defaultdict(list)
+        for (person_handle, event_type, sortval, date) in \
+                self.place_events[place_handle]:
+            (name, gramps_id, index) = persons[person_handle]
+            events[event_type].append((sortval, index, name, gramps_id, date))
+        for event_type in self.PLACE_EVENT_TYPES:
+            if event_type not in events:
+                continue
+            items = []
+            for (sortval, index, name, gramps_id, date) in \
+                    sorted(events[event_type]):
+                item = name
+                if date:
+                    item += ' (\\mbox{' + date + '})'
+                items.append(item + ', ' + self.page_abbrev + '~\\pageref{' +
+                             gramps_id + '}')
+            self.__add_person_overview(
+                out, self.place_event_titles[event_type],
+                self.__needs_trailing_dot('; '.join(items)))
+        out.append('\\fbEndPersonDescription\n')
+
+    def __sort_places(self, place_handles):
+        """
+        Return the place handles in the order of the place hierarchy: every
+        place is sorted by the names of its enclosing places from the top
+        down, then by its own name.
+        """
+        paths = {}
+        def get_path(place_handle):
+            if place_handle not in paths:
+                # guard against cycles in the place hierarchy
+                paths[place_handle] = ()
+                place = self.db.get_place_from_handle(place_handle)
+                placeref_list = place.get_placeref_list()
+                path = get_path(placeref_list[0].ref) if placeref_list else ()
+                paths[place_handle] = path + (
+                    self.__collation_key(place.get_name().get_value()),
+                    place_handle)
+            return paths[place_handle]
+        return sorted(place_handles, key = get_path)
+
+    def __write_bibliography(self):
+        """
+        Write the bibliography of the cited citations, an item at a time.
+        """
+        self.out.write('\\begin{thebibliography}{99}\n\\scriptsize\n')
+        with Progress(self.user, _("Writing bibliography"),
+                      len(self.citations)) as progress:
+            for item in self.citations.get_items():
+                self.out.write(item)
+                progress.step()
+        self.out.write('\\end{thebibliography}\n')
+
+    def __write_name_index(self):
+        """
+        Write the name index, sorted by the collation keys of the surnames
+        and given names and grouped by surname, so that no makeindex run is
+        needed. Every surname group is written as soon as it is made.
+        """
+        persons = self.obj_dict[Person]
+        key = self.__collation_key
+        if self.spill is None:
+            with _no_gc():
+                entries = sorted(self.name_index, key = lambda entry: (
+                    key(entry[0]), key(entry[1]), persons.sort_keys[entry[2]]))
+            entries = ((surname, given, persons.gramps_ids[index],
+                        primary_surname)
+                       for (surname, given, index, primary_surname) in entries)
+        else:
+            entries = (record[1:] for record in self.name_index)
+        out = ['\\begin{multicols}{2}\n', '\\footnotesize\n']
+        surname_key = None
+        with Progress(self.user, _("Writing name index"),
+                      len(self.name_index)) as progress:
+            for (surname, given, gramps_id, primary_surname) in entries:
+                if key(surname) != surname_key:
+                    surname_key = key(surname)
+                    self.out.write(''.join(out))
+                    out = ['\\fbNameIndexSurname{', surname, '}\n']
+                out += ['\\fbNameIndexEntry{', given or '---']
+                if primary_surname is not None:
+                    # the chapter is titled by the primary name
+                    out += [' (', primary_surname, ')']
+                out += ['}{', gramps_id, '}\n']
+                progress.step()
+        out.append('\\end{multicols}\n')
+        self.out.write(''.join(out))
+
+    def _render_chapter(self, person_handle):
+        """
+        Render the chapter of a person.
+
+        @param person_handle: handle of the person.
+        @return: tuple of (chapter text, list of cited citation handles,
+                 list of (place handle, event type, date sort value, date
+                 text) of the events of the person for the gazetteer)
+        """
+        start = time.perf_counter()
+        person = self.db.get_person_from_handle(person_handle)
+        self.chapter_citations = []
+        self.chapter_places = []
+        chapter = (self.__process_person(person), self.chapter_citations,
+                   self.chapter_places)
+        if self.instrumentation is not None:
+            self.instrumentation.add_person(person.get_gramps_id(),
+                                            time.perf_counter() - start)
+        return chapter
+
+    def __render_chapters(self, person_list):
+        """
+        Render chapters of the persons, yielding them in the order of
+        person_list.
+        """
+        if self.__is_parallel():
+            return self.__render_chapters_parallel(person_list)
+        if self.pipeline_depth:
+            return self.__render_chapters_pipelined(person_list)
+        return (self._render_chapter(h) for h in person_list)
+
+    def __render_chapters_pipelined(self, person_list):
+        """
+        Render the chapters in this thread while a reader thread reads the
+        objects of the next persons ahead into the object cache.
+        """
+        cache = self.db.database if self.prefetch else self.db
+        records = self.db.records if self.prefetch else {}
+        database = self.database
+        if self.instrumentation is not None:
+            # the reads of the reader show in its stall times instead
+            database = database.database
+        reader = ChapterReader(database, cache, records, self.pipeline_depth,
+                               min(self.pipeline_depth, _PIPELINE_READERS))
+        reader.start()
+        try:
+            # the person list is only iterated in this thread
+            handles = iter(person_list)
+            for handle in islice(handles, self.pipeline_depth):
+                reader.request(handle)
+            while True:
+                item = reader.get()
+                if item is None:
+                    return
+                for handle in islice(handles, 1):
+                    reader.request(handle)
+                (person_handle, objects) = item
+                for (obj_type, handle, obj) in objects:
+                    cache.prime(obj_type, handle, obj)
+                reader.done(objects)
+                yield self._render_chapter(person_handle)
+        finally:
+            reader.stop()
+            self.pipeline_stats['read'] = reader.get_stats()
+
+    def __is_parallel(self):
+        """
+        Return True if chapters are rendered in worker processes; not in the
+        low memory mode, where they are rendered one at a time.
+        """
+        return (self.jobs > 1 and self.spill is None and
+                'fork' in multiprocessing.get_all_start_methods())
+
+    def __render_chapters_cached(self, person_list):
+        """
+        Like __render_chapters, but only render the persons whose cached
+        chapter is missing or stale.
+        """
+        if not self.__is_parallel():
+            for handle in person_list:
+                signature = self.__chapter_signature(handle)
+                if self.chapter_cache.is_valid(handle, signature):
+                    yield self.chapter_cache.load(handle)
+                else:
+                    chapter = self._render_chapter(handle)
+                    self.chapter_cache.store(handle, signature, chapter)
+                    yield chapter
+            return
+
+        # the stale chapters are rendered ahead in the worker processes
+        person_list = list(person_list)
+        signatures = {}
+        stale = []
+        for handle in person_list:
+            signature = self.__chapter_signature(handle)
+            if not self.chapter_cache.is_valid(handle, signature):
+                signatures[handle] = signature
+                stale.append(handle)
+
+        rendered = self.__render_chapters(stale)
+        for handle in person_list:
+            if handle in signatures:
+                chapter = next(rendered)
+                self.chapter_cache.store(handle, signatures[handle], chapter)
+            else:
+                chapter = self.chapter_cache.load(handle)
+            yield chapter
+
+    def __chapter_signature(self, person_handle):
+        """
+        Compute the signature of everything the chapter of a person is
+        rendered from: the change times of the person, its events (and its
+        marriages) with their places and citations, its families, parents,
+        spouses (and whether they have a chapter) and notes, and the report
+        options.
+        """
+        database = self.database
+        person = database.get_raw_person_data(person_handle)
+        items = [self.__options_key, person_handle, person[_PERSON_CHANGE]]
+        for event_ref in person[_PERSON_EVENT_REFS]:
+            self.__add_event_signature(items, event_ref[_EVENT_REF_REF])
+        for fam_handle in (person[_PERSON_PARENT_FAMILIES] +
+                           person[_PERSON_FAMILIES]):
+            family = database.get_raw_family_data(fam_handle)
+            if not family:
+                continue
+            items += [fam_handle, family[_FAMILY_CHANGE]]
+            if fam_handle in person[_PERSON_FAMILIES]:
+                # marriages are listed in the gazetteer
+                for event_ref in family[_FAMILY_EVENT_REFS]:
+                    self.__add_event_signature(items, event_ref[_EVENT_REF_REF])
+            for handle in (family[_FAMILY_FATHER], family[_FAMILY_MOTHER]):
+                if handle:
+                    relative = database.get_raw_person_data(handle)
+                    if relative:
+                        items += [handle, relative[_PERSON_CHANGE],
+                                  handle in self.obj_dict[Person]]
+        if self.relationships is not None:
+            items += [self.relationships.get(person_handle),
+                      self.relationships.get_role_paths(person_handle)]
+        if self.photos is not None:
+            items.append(self.photos.get(person_handle))
+        for note_handle in person[_PERSON_NOTES]:
+            note = database.get_raw_note_data(note_handle)
+            if note:
+                items += [note_handle, note[_NOTE_CHANGE]]
+        return hashlib.sha1('\n'.join(map(str, items)).encode('utf-8')).hexdigest()
+
+    def __add_event_signature(self, items, event_handle):
+        """
+        Add the change times of an event, its citations and places to the
+        signature items.
+        """
+        database = self.database
+        event = database.get_raw_event_data(event_handle)
+        if not event:
+            return
+        items += [event_handle, event[_EVENT_CHANGE]]
+        for cit_handle in event[_EVENT_CITATIONS]:
+            citation = database.get_raw_citation_data(cit_handle)
+            if citation:
+                items += [cit_handle, citation[_CITATION_CHANGE]]
+                # the source makes the bibliography item and merged keys
+                src_handle = citation[_CITATION_SOURCE]
+                source = database.get_raw_source_data(src_handle)
+                if source:
+                    items += [src_handle, source[_SOURCE_CHANGE]]
+        place_handle = event[_EVENT_PLACE]
+        while place_handle:
+            place = database.get_raw_place_data(place_handle)
+            if not place:
+                break
+            items += [place_handle, place[_PLACE_CHANGE]]
+            place_refs = place[_PLACE_PLACEREFS]
+            place_handle = place_refs[0][_PLACEREF_REF] if place_refs else None
+
+    def __render_chapters_parallel(self, person_list):
+        """
+        Render chapters in forked worker processes, yielding them in the
+        order of person_list.
+        """
+        person_list = iter(person_list)
+        batches = iter(lambda: list(islice(person_list, _CHAPTER_BATCH)), [])
+        with ProcessPoolExecutor(max_workers = self.jobs,
+                                 mp_context = multiprocessing.get_context('fork'),
+                                 initializer = _init_chapter_worker,
+                                 initargs = (self,)) as executor:
+            # only a few batches are submitted ahead, so that a cancelled
+            # run does not wait for the rendering of all the rest
+            futures = deque(executor.submit(_render_chapters, batch)
+                            for batch in islice(batches, 2 * self.jobs))
+            while futures:
+                (chapters, data) = futures.popleft().result()
+                for batch in islice(batches, 1):
+                    futures.append(executor.submit(_render_chapters, batch))
+                if data is not None:
+                    self.instrumentation.merge(data)
+                for chapter in chapters:
+                    yield chapter
+
+    def _reopen_database(self):
+        """
+        Replace the database connection inherited from the parent process
+        with a private read-only one.
+        """
+        database = _open_database_copy(self.database)
+        if database is self.database:
+            return
+        if self.instrumentation is not None:
+            database = InstrumentedDatabase(database, self.instrumentation)
+        self.database = database
+        cache = self.db.database if self.prefetch else self.db
+        cache.database = self.database
+
+    def __format_context(self):
+        """
+        Return the display options the cached formatted strings depend on:
+        the language of the report locale and the date format in effect.
+        """
+        return (self.rlocale.lang, self._ldd.format)
 
-        # setup a dictionary of the required structure
-        self.obj_dict = defaultdict(lambda: defaultdict(set))
-        self.bkref_dict = defaultdict(lambda: defaultdict(set))
+    def __report_summary(self):
+        """
+        Tell the user in one line how much the chapter and object caches
+        saved. Not in the GUI, where it would be a dialog after every run;
+        the full statistics are shown with instrumentation.
+        """
+        if _is_gui_user(self.user):
+            return
+        parts = []
+        if self.chapter_cache is not None:
+            parts.append(_("%(reused)d chapters reused, %(rebuilt)d rebuilt")
+                         % {'reused': self.chapter_cache.reused,
+                            'rebuilt': self.chapter_cache.rebuilt})
+        cache = self.db.database if self.prefetch else self.db
+        hits = misses = 0
+        for (obj_type, obj_hits, obj_misses) in cache.get_stats():
+            hits += obj_hits
+            misses += obj_misses
+        parts.append(_("%(hits)d object cache hits, %(misses)d misses")
+                     % {'hits': hits, 'misses': misses})
+        self.user.info(_('Family Book caches:'), '; '.join(parts))
 
+    def __report_stats(self):
+        """
+        Show the object and format cache statistics to the user.
+        """
+        lines = []
+        if self.chapter_cache is not None:
+            lines.append('chapter cache: %d reused, %d rebuilt'
+                         % (self.chapter_cache.reused,
+                            self.chapter_cache.rebuilt))
+        cache = self.db
+        if self.prefetch:
+            for (obj_type, count) in cache.get_stats():
+                lines.append('%s prefetch: %d records' % (obj_type, count))
+            cache = cache.database
+        for (obj_type, hits, misses) in cache.get_stats():
+            if hits or misses:
+                lines.append('%s cache: %d hits, %d misses'
+                             % (obj_type, hits, misses))
+        if self.spill is not None:
+            lines.append('low memory mode: %d sort runs spilled'
+                         % self.spill.runs)
+        if self.photos is not None:
+            lines.append('portraits: %d scaled, %d reused, %d unreadable'
+                         % (self.photos.made, self.photos.reused,
+                            self.photos.failed))
+        for (name, stats) in self.pipeline_stats.items():
+            lines.append('pipeline %s queue: %.1f mean and %d maximum depth '
+                         'of %d, producer stalled %.2f s, consumer stalled '
+                         '%.2f s' % (name, stats['mean_depth'],
+                                     stats['max_depth'], stats['size'],
+                                     stats['producer_stall'],
+                                     stats['consumer_stall']))
+        for (name, cache) in (('place title', self.place_titles),
+                              ('date', self.date_strings)):
+            lines.append('%s cache: %d hits, %d misses'
+                         % (name, cache.hits, cache.misses))
+        self.user.info(_('Family Book statistics'), '\n'.join(lines),
+                       monospaced = True)
 
-        # initialise the dictionary to empty in case no objects of any
-        # particular class are included in the web report
-        for obj_class in _obj_class_list:
-            self.obj_dict[obj_class] = defaultdict(set)
+    def citation_key(self, cit, src):
+        """
+        Return the bibliography key of a citation: its Gramps ID, or if
+        citations are merged, the source Gramps ID and the SHA-256 hash of
+        the page, shared by all the citations of the same source page.
+        Chapters may be rendered in other processes or reused from the
+        chapter cache, so the key depends on the page only.
+        """
+        if not self.merge_citations:
+            return cit.get_gramps_id()
+        page = cit.get_page().encode('utf-8')
+        return '%s-%s' % (src.get_gramps_id(), hashlib.sha256(page).hexdigest())
 
-        ind_list = self.database.iter_person_handles()
-#        ind_list = self.filter.apply(self.database, ind_list, user=self.user)
+    def __make_bib_item(self, key, cit, src):
+        out = ['\\bibitem{', key, '} ',
+               self.__needs_trailing_dot(src.get_title())]
+        if src.get_author() != '':
+            out += [' {\\itshape ', self.__needs_trailing_dot(src.get_author()), '}']
+        if src.get_publication_info() != '':
+            out += [' ', self.__needs_trailing_dot(src.get_publication_info())]
+        out += ['~// ', self.__needs_trailing_dot(cit.get_page()), '\n']
+        return ''.join(out)
+        
+    def _build_obj_dict(self):
+        # setup a dictionary of the required structure; persons, with
+        # their back references, are kept in a compact index
+        if self.spill is None:
+            persons = PersonIndex()
+        else:
+            persons = SpilledPersonIndex(self.spill)
+        self.obj_dict = {Person: persons, Place: defaultdict(set)}
+        # handles of all the persons within the scope of the report, valid
+        # or not, None for the whole database
+        self.scope_handles = None
+        if self.name_index is not None:
+            self.name_index = [] if self.spill is None else ExternalSorter(self.spill)
+        self.__collation_keys = {}
+        if self.spill is None:
+            self.kinship = KinshipIndex()
+        else:
+            self.kinship = KinshipIndex(SpillDict(self.spill, 'family'),
+                                        SpillDict(self.spill, 'relative'))
 
-        for handle in ind_list:
-            self._add_person(handle)
+        # raw person data is enough to validate and name a person, full
+        # Person objects are only built for the chapters
+        if self.scope == FamilyBookOptions.SCOPE_ALL:
+            with Progress(self.user, _("Collecting persons"),
+                          self.database.get_number_of_people()) as progress:
+                with self.database.get_person_cursor() as cursor:
+#                    ind_list = self.filter.apply(self.database, ind_list, user=self.user)
+                    for (handle, data) in cursor:
+                        self._add_person(handle, person_data = data)
+                        progress.step()
+        else:
+            families = {}
+            with Progress(self.user, _("Collecting persons")) as progress:
+                for (handle, data) in self.__iter_scope(families):
+                    self._add_person(handle, person_data = data)
+                    if handle in persons:
+                        self.__add_kinship_families(data, families)
+                    progress.step()
+        self._build_kinship()
 
         # Debug output
 #        log.debug("final object dictionary \n" +
 #                  "".join(("%s: %s\n" % item) for item in self.obj_dict.items()))
 
 #        log.debug("final backref dictionary \n" +
-#                  "".join(("%s: %s\n" % item) for item in self.bkref_dict.items()))
+#                  "".join(("%s: %s\n" % (handle, self.obj_dict[Person].get_back_references(handle))) for handle in self.obj_dict[Person]))
+
+    def __add_kinship_families(self, person_data, families):
+        """
+        Index the parents of the families a person of the book is a parent
+        or a child in, reading only the families not indexed yet.
+
+        @param person_data: raw person data
+        @param families: dictionary of the raw data of the families read,
+                         shared with the scope traversal
+        """
+        for fam_handles in (person_data[_PERSON_PARENT_FAMILIES],
+                            person_data[_PERSON_FAMILIES]):
+            for fam_handle in fam_handles:
+                if fam_handle in self.kinship:
+                    continue
+                if fam_handle not in families:
+                    families[fam_handle] = self.database.get_raw_family_data(fam_handle)
+                data = families[fam_handle]
+                if data:
+                    self.kinship.add_family(fam_handle, data[_FAMILY_FATHER],
+                                            data[_FAMILY_MOTHER])
+
+    def _build_kinship(self):
+        """
+        Index the parents of the families the persons of the book are
+        parents or children in, and name those parents who have no
+        chapter. The families of a scoped book are indexed as its persons
+        are collected, those of a book of all the persons by scanning the
+        family table once.
+        """
+        persons = self.obj_dict[Person]
+        if self.scope == FamilyBookOptions.SCOPE_ALL:
+            with Progress(self.user, _("Collecting families")) as progress:
+                with self.database.get_family_cursor() as cursor:
+                    for (handle, data) in cursor:
+                        father_handle = data[_FAMILY_FATHER]
+                        mother_handle = data[_FAMILY_MOTHER]
+                        if (father_handle in persons or
+                                mother_handle in persons or
+                                any(child_ref[_CHILD_REF_REF] in persons
+                                    for child_ref in data[_FAMILY_CHILDREN])):
+                            self.kinship.add_family(handle, father_handle,
+                                                    mother_handle)
+                        progress.step()
+        for parents in self.kinship.get_all_parents():
+            for handle in parents:
+                if (handle and handle not in persons and
+                        not self.kinship.has_name(handle)):
+                    data = self.database.get_raw_person_data(handle)
+                    if data:
+                        self.kinship.add_name(handle,
+                                              self.__raw_person_name(data))
+
+    def _build_relationships(self):
+        """
+        Find the blood relationships of the persons to the center person.
+        """
+        center = self.database.get_person_from_gramps_id(self.person_id)
+        if center is None:
+            return
+        self.center_gender = center.get_gender()
+        self.relationships = RelationshipMap(self.database)
+        # the relatives outside of the scope of the book need not be
+        # searched; the persons within it are kept, even those without a
+        # chapter, as relatives may be reached through them
+        max_generations = None
+        if self.scope == FamilyBookOptions.SCOPE_CONNECTED:
+            # every person on the path to the closest common ancestor of a
+            # relative within the step limit is in the book too; that of a
+            # more distant relative, met through a marriage, may be out of
+            # it, so the closest relationship could not be told
+            max_generations = self.scope_steps
+        self.relationships.build(center.get_handle(), self.scope_handles,
+                                 max_generations)
+
+    def __relationship_title(self, person):
+        """
+        Return how the person is related to the center person, an empty
+        string if the person is not a blood relative.
+        """
+        if self.relationships is None:
+            return ''
+        generations = self.relationships.get(person.get_handle())
+        if generations is None or generations == (0, 0):
+            return ''
+        (up, down) = generations
+        # some languages tell e.g. the father's and the mother's father apart
+        (center_path, person_path) = self.relationships.get_role_paths(
+            person.get_handle())
+        key = (up, down, person.get_gender(), center_path, person_path)
+        title = self.__relationship_titles.get(key)
+        if title is None:
+            title = self.rel_calc.get_single_relationship_string(
+                up, down, self.center_gender, person.get_gender(),
+                center_path, person_path)
+            self.__relationship_titles[key] = title
+        return title
+
+    def __iter_scope(self, families):
+        """
+        Breadth-first traversal from the center person over parent and
+        family links, yielding (handle, raw data) of the persons within
+        the scope of the report.
+
+        @param families: dictionary filled in with the raw data of the
+                         families read
+        """
+        center = self.database.get_person_from_gramps_id(self.person_id)
+        if center is None:
+            raise ReportError(
+                _("The center person was not found"),
+                _("The scope of the book is set from the center person, "
+                  "but there is no person with the ID '%s'.")
+                % self.person_id)
+        up = self.scope in (FamilyBookOptions.SCOPE_ANCESTORS,
+                            FamilyBookOptions.SCOPE_CONNECTED)
+        down = self.scope in (FamilyBookOptions.SCOPE_DESCENDANTS,
+                              FamilyBookOptions.SCOPE_CONNECTED)
+        side = self.scope == FamilyBookOptions.SCOPE_CONNECTED
+        max_steps = self.scope_steps if side else None
+
+        def get_family(fam_handle):
+            if fam_handle not in families:
+                families[fam_handle] = self.database.get_raw_family_data(fam_handle)
+            return families[fam_handle]
+
+        seen = set([center.handle])
+        self.scope_handles = seen
+        queue = deque([(center.handle, 0)])
+        while queue:
+            (handle, steps) = queue.popleft()
+            data = self.database.get_raw_person_data(handle)
+            if not data:
+                continue
+            yield (handle, data)
+            if max_steps is not None and steps >= max_steps:
+                continue
 
-    def _add_person(self, person_handle, bkref_class = None, bkref_handle = None):
+            relatives = []
+            if up:
+                for fam_handle in data[_PERSON_PARENT_FAMILIES]:
+                    family = get_family(fam_handle)
+                    if family:
+                        relatives += [family[_FAMILY_FATHER], family[_FAMILY_MOTHER]]
+            if down or side:
+                for fam_handle in data[_PERSON_FAMILIES]:
+                    family = get_family(fam_handle)
+                    if not family:
+                        continue
+                    if side:
+                        relatives += [family[_FAMILY_FATHER], family[_FAMILY_MOTHER]]
+                    if down:
+                        relatives += [child_ref[_CHILD_REF_REF]
+                                      for child_ref in family[_FAMILY_CHILDREN]]
+            for relative in relatives:
+                if relative and relative not in seen:
+                    seen.add(relative)
+                    queue.append((relative, steps + 1))
+
+    def _add_person(self, person_handle, bkref_class = None, bkref_handle = None,
+                    person_data = None):
         '''
         Add person_handle to the L{self.obj_dict}, and recursively all referenced objects
+
+        @param person_data: raw person data, read from the database if omitted
         '''
         # Update the dictionaries of objects back references
         if (bkref_class is not None):
-            self.bkref_dict[Person][person_handle].add((bkref_class, bkref_handle, None))
+            self.obj_dict[Person].add_back_reference(person_handle, bkref_class, bkref_handle)
         # Check if the person is already added
         if (person_handle in self.obj_dict[Person]): return
         # Add person in the dictionaries of objects
-        person = self.database.get_person_from_handle(person_handle)
-        if (not person): return
-        if (not self.__is_person_valid(person)): return
-        person_name = self.__person_name(person)
-        self.obj_dict[Person][person_handle] = [person_name, person.gramps_id, len(self.obj_dict[Person])]
+        if (person_data is None):
+            person_data = self.database.get_raw_person_data(person_handle)
+        if (not person_data): return
+        if (not self.__is_raw_person_valid(person_data)): return
+        person_name = self.__raw_person_name(person_data)
+        sort_key = self.__raw_person_sort_key(person_data)
+        index = self.obj_dict[Person].add(
+            person_handle, person_name, person_data[_PERSON_GRAMPS_ID],
+            sort_key)
+        if self.name_index is not None:
+            self.__add_index_names(index, sort_key, person_data)
+        if self.photos is not None:
+            self.__add_portrait(person_handle, person_data)
         # Person events
 #        evt_ref_list = person.get_event_ref_list()
 #        if evt_ref_list:
@@ -257,6 +3843,47 @@ class FamilyBook(Report):
 #            for citation_handle in addr.get_citation_list():
 #                self._add_citation(citation_handle, Person, person_handle)
 
+    def __add_index_names(self, index, sort_key, person_data):
+        """
+        File the primary and the alternate names of a person in the name
+        index, each distinct name once.
+        """
+        primary = person_data[_PERSON_PRIMARY_NAME]
+        surname = _raw_surname(primary)
+        given = _raw_given_name(primary)
+        entries = [(surname, given, None)]
+        seen = set([(surname, given)])
+        for name in person_data[_PERSON_ALTERNATE_NAMES]:
+            # e.g. maiden names usually have the surname only
+            entry = (_raw_surname(name), _raw_given_name(name) or given)
+            if entry[0] and entry not in seen:
+                seen.add(entry)
+                entries.append(entry + (surname,))
+        key = self.__collation_key
+        for (surname, given, primary_surname) in entries:
+            if self.spill is None:
+                self.name_index.append((surname, given, index, primary_surname))
+            else:
+                # sorted on disk, the record holds everything written
+                self.name_index.add(((key(surname), key(given), sort_key),
+                                     surname, given,
+                                     person_data[_PERSON_GRAMPS_ID],
+                                     primary_surname))
+
+    def __add_portrait(self, person_handle, person_data):
+        """
+        Add the first image among the media of a person as the portrait.
+        """
+        for media_ref in person_data[_PERSON_MEDIA]:
+            media = self.database.get_raw_media_data(media_ref[_MEDIA_REF_REF])
+            if media and (media[_MEDIA_MIME] or '').startswith('image/'):
+                region = media_ref[_MEDIA_REF_RECT]
+                self.photos.add(person_handle,
+                                media_path_full(self.database,
+                                                media[_MEDIA_PATH]),
+                                tuple(region) if region else None)
+                return
+
     def __person_name(self, person):
         """
         Construct person name.
@@ -269,18 +3896,62 @@ class FamilyBook(Report):
                 if int(alt_name.get_type()) == NameType.BIRTH:
                     maindenName = ' (' + alt_name.get_surname() + ')'
 
-        return displayer.display_name(person.get_primary_name()) + maindenName
+        return self._display_name(person.get_primary_name()) + maindenName
+
+    def __raw_person_name(self, data):
+        """
+        Construct person name from raw person data, same as __person_name.
+
+        @param data: raw person data.
+        """
+        name = Name().unserialize(data[_PERSON_PRIMARY_NAME])
+        maindenName = ''
+        if int(name.get_type()) == NameType.MARRIED:
+            for alt_name in data[_PERSON_ALTERNATE_NAMES]:
+                if alt_name[_NAME_TYPE][0] == NameType.BIRTH:
+                    maindenName = ' (' + _raw_surname(alt_name) + ')'
+
+        return self._display_name(name) + maindenName
+
+    def __raw_person_sort_key(self, data):
+        """
+        Return the chapter order key of a person from raw person data:
+        collation keys of the surname and given name with the patronymic in
+        the report locale, as in the name index, the birth date and the
+        Gramps ID to keep the order stable.
+
+        @param data: raw person data.
+        """
+        name = data[_PERSON_PRIMARY_NAME]
+        birth_sortval = 0
+        birth_index = data[_PERSON_BIRTH_REF_INDEX]
+        if 0 <= birth_index < len(data[_PERSON_EVENT_REFS]):
+            event_handle = data[_PERSON_EVENT_REFS][birth_index][_EVENT_REF_REF]
+            event = self.database.get_raw_event_data(event_handle)
+            # an empty date is stored as None
+            if event and event[_EVENT_DATE]:
+                birth_sortval = event[_EVENT_DATE][_DATE_SORTVAL]
+        return (self.__collation_key(_raw_surname(name)),
+                self.__collation_key(_raw_given_name(name)),
+                birth_sortval, data[_PERSON_GRAMPS_ID])
+
+    def __collation_key(self, text):
+        # names repeat a lot, so keys are computed once per distinct name
+        key = self.__collation_keys.get(text)
+        if key is None:
+            key = self.rlocale.sort_key(text)
+            self.__collation_keys[text] = key
+        return key
 
-    def __is_person_valid(self, person):
+    def __is_raw_person_valid(self, data):
         """
         Checks if person should be added to the book.
 
-        @param person: Person object.
+        @param data: raw person data.
         """
-        if person.get_primary_name().get_surname() == '':
+        if _raw_surname(data[_PERSON_PRIMARY_NAME]) == '':
             return False
-        event_ref = person.get_birth_ref()
-        if event_ref is None:
+        if not (0 <= data[_PERSON_BIRTH_REF_INDEX] < len(data[_PERSON_EVENT_REFS])):
             return False
 
         return True
@@ -294,158 +3965,213 @@ class FamilyBook(Report):
             str = str + '.'
         return str
         
-    def __prepare_tex_for_latex(self, str):
-        str = str.replace('&nbsp;', '~')
-        return str
-    
-    def __add_person_overview(self, title, value):
+    def __add_person_overview(self, out, title, value):
         if value is not None:
-            self.doc.write_text('\\fbPersonDescriptionItem{')
-            self.doc.write_text(title)
-            self.doc.write_text('}{')
-            self.doc.write_text(value)
-            self.doc.write_text('}\n')
+            out += ['\\fbPersonDescriptionItem{', title, '}{', value, '}\n']
 
     def __get_source_cites(self, event):
-        cites = ''
+        cites = []
         for cit_handle in event.get_citation_list():
             if cit_handle:
-                cit = self.database.get_citation_from_handle(cit_handle)
-                if cites != '':
-                    cites = cites + ', '
-                cites = cites + cit.get_gramps_id()
-                self.citation_handles.add(cit_handle)
-        if cites != '':
-            cites = '~\cite{' + cites + '}'
-        return cites
+                cit = self.db.get_citation_from_handle(cit_handle)
+                src = None
+                if self.merge_citations:
+                    src = self.db.get_source_from_handle(
+                        cit.get_reference_handle())
+                key = self.citation_key(cit, src)
+                if key not in cites:
+                    cites.append(key)
+                self.chapter_citations.append(cit_handle)
+        if cites:
+            return '~\cite{' + ', '.join(cites) + '}'
+        return ''
         
-    def __add_person_event(self, person, event, title, disp_date = False):
+    def __place_title_key(self, event):
+        """
+        Return the place title cache key of an event. The event date is
+        a part of the key only if a name of the place or of its enclosing
+        places, or a link between them, is limited in time.
+        """
+        place_handle = event.get_place_handle()
+        if self.__is_place_dated(place_handle):
+            return (place_handle, _date_key(event.get_date_object()))
+        return (place_handle, None)
+
+    def __is_place_dated(self, place_handle):
+        dated = self.__dated_places.get(place_handle)
+        if dated is None:
+            # guard against cycles in the place hierarchy
+            self.__dated_places[place_handle] = True
+            place = self.db.get_place_from_handle(place_handle)
+            dated = (any(not name.get_date_object().is_empty()
+                         for name in place.get_all_names()) or
+                     any(not placeref.get_date_object().is_empty() or
+                         self.__is_place_dated(placeref.ref)
+                         for placeref in place.get_placeref_list()))
+            self.__dated_places[place_handle] = dated
+        return dated
+
+    def __add_person_event(self, out, person, event, title, disp_date = False):
         if event is None:
             return
         str = ''
 
         if disp_date:
-            dt = self.rlocale.get_date(event.get_date_object())
+            date = event.get_date_object()
+            dt = self.date_strings.get(_date_key(date), self._get_date, date)
             if dt:
                 str = '\\mbox{' + dt + '}'
             
         if event.get_place_handle():
             if str != '':
                 str = str + ', '
-            str = str + place_displayer.display_event(self.database, event)
+            str = str + self.place_titles.get(
+                self.__place_title_key(event), self._display_event,
+                self.db, event)
+            self.__add_place_event(event)
 
         if str != '':
             if event.get_description():
                 str = str + ' (' + self.__lowercase_first_letter(event.get_description()) + ')'
             str = self.__needs_trailing_dot(str)
             cites = self.__get_source_cites(event)
-            self.__add_person_overview(title, str + cites)
+            self.__add_person_overview(out, title, str + cites)
             
-    def __add_person_event_ref(self, person, event_ref, title, disp_date = False):
+    def __add_place_event(self, event):
+        """
+        Record an event of the person for the gazetteer if it is listed there.
+        """
+        event_type = int(event.get_type())
+        if event_type not in self.PLACE_EVENT_TYPES:
+            return
+        date = event.get_date_object()
+        self.chapter_places.append(
+            (event.get_place_handle(), event_type, date.get_sort_value(),
+             self.date_strings.get(_date_key(date), self._get_date, date)))
+
+    def __add_family_places(self, family):
+        """
+        Record the marriage events with a place of a family for the gazetteer.
+        """
+        for event_ref in family.get_event_ref_list():
+            event = self.db.get_event_from_handle(event_ref.ref)
+            if (event and event.get_place_handle() and
+                    int(event.get_type()) == EventType.MARRIAGE):
+                self.__add_place_event(event)
+
+    def __add_person_event_ref(self, out, person, event_ref, title, disp_date = False):
         if event_ref is None:
             return
         if event_ref.get_role() != EventRoleType.PRIMARY:
             return
-        event = self.database.get_event_from_handle(event_ref.ref)
-        self.__add_person_event(person, event, title, disp_date)
+        event = self.db.get_event_from_handle(event_ref.ref)
+        self.__add_person_event(out, person, event, title, disp_date)
         
-    def __add_person_birth(self, person):
+    def __add_person_birth(self, out, person):
         if int(person.get_gender()) == Person.FEMALE:
             title = "Родилась" # TODO
         else:
             title = "Родился" # TODO
-        self.__add_person_event_ref(person, person.get_birth_ref(), title, True)
+        self.__add_person_event_ref(out, person, person.get_birth_ref(), title, True)
     
-    def __add_person_death(self, person):
+    def __add_person_death(self, out, person):
         if int(person.get_gender()) == Person.FEMALE:
             title = "Умерла" # TODO
         else:
             title = "Умер" # TODO
-        self.__add_person_event_ref(person, person.get_death_ref(), title, True)
+        self.__add_person_event_ref(out, person, person.get_death_ref(), title, True)
 
-    def __make_person_parent(self, parent):
-        s = self.__person_name(parent)
-        if self.__is_person_valid(parent):
-            s = s + ', ' + 'с.' + '~\\pageref{' + parent.get_gramps_id() + '}' # TODO
+    def __make_person_parent(self, parent_handle):
+        """
+        Return the line naming a parent or a spouse, with the page of their
+        chapter if any, from the kinship index; empty if the person is
+        missing.
+        """
+        persons = self.obj_dict[Person]
+        if parent_handle in persons:
+            (name, gramps_id, index) = persons[parent_handle]
+            s = (name + ', ' + self.page_abbrev + '~\\pageref{' + gramps_id +
+                 '}')
+        else:
+            s = self.kinship.get_name(parent_handle)
+            if s is None:
+                return ''
         return self.__needs_trailing_dot(s)
         
-    def __add_person_parent(self, parent, title):
-        self.__add_person_overview(title, self.__make_person_parent(parent))
+    def __add_person_parent(self, out, parent_handle, title):
+        s = self.__make_person_parent(parent_handle)
+        if s != '':
+            self.__add_person_overview(out, title, s)
         
     def __process_person(self, person):
-        self.doc.start_paragraph('FSR-Normal')
-        self.doc.write_text('\\chapter{')
-        self.doc.write_text(self.__person_name(person))
-        self.doc.write_text('}\n')
-        self.doc.write_text('\\label{')
-        self.doc.write_text(person.get_gramps_id())
-        self.doc.write_text('}\n')
-        self.doc.write_text('\\small\n')
-        self.doc.write_text('\\fbBeginPersonDescription\n')
+        """
+        Return the LaTeX chapter of a person.
+        """
+        out = ['\\chapter{', self.__person_name(person), '}\n',
+               '\\label{', person.get_gramps_id(), '}\n']
+        if self.photos is not None:
+            photo = self.photos.get(person.get_handle())
+            if photo:
+                out += ['\\fbPortrait{', self.photo_prefix, photo, '}\n']
+        out += ['\\small\n', '\\fbBeginPersonDescription\n']
+
+        relationship = self.__relationship_title(person)
+        if relationship:
+            self.__add_person_overview(out, _("Relationship"),
+                                       self.__needs_trailing_dot(relationship))
         
-        self.__add_person_birth(person)
-        self.__add_person_death(person)
+        self.__add_person_birth(out, person)
+        self.__add_person_death(out, person)
         for event_ref in person.get_primary_event_ref_list():
-            event = self.database.get_event_from_handle(event_ref.ref)
+            event = self.db.get_event_from_handle(event_ref.ref)
             if event and int(event.get_type()) == EventType.BURIAL:
                 if int(person.get_gender()) == Person.FEMALE:
                     title = "Похоронена" # TODO
                 else:
                     title = "Похоронен" # TODO
-                self.__add_person_event(person, event, title, False)
+                self.__add_person_event(out, person, event, title, False)
 
         parents = set()
         for fam_handle in person.get_parent_family_handle_list():
-            family = self.database.get_family_from_handle(fam_handle)
-            father_handle = family.get_father_handle()
+            (father_handle, mother_handle) = self.kinship.get_parents(fam_handle)
             if father_handle and not(father_handle in parents):
-                father = self.database.get_person_from_handle(father_handle)
-                self.__add_person_parent(father, _("Father"))
+                self.__add_person_parent(out, father_handle, _("Father"))
                 parents.add(father_handle)
-            mother_handle = family.get_mother_handle()
             if mother_handle and not(mother_handle in parents):
-                mother = self.database.get_person_from_handle(mother_handle)
-                self.__add_person_parent(mother, _("Mother"))
+                self.__add_person_parent(out, mother_handle, _("Mother"))
                 parents.add(mother_handle)
 
-        s = ''
+        spouses = []
         for fam_handle in person.get_family_handle_list():
-            family = self.database.get_family_from_handle(fam_handle)
+            family = self.db.get_family_from_handle(fam_handle)
+            self.__add_family_places(family)
             s2 = ''
+            (father_handle, mother_handle) = self.kinship.get_parents(fam_handle)
             if int(person.get_gender()) == Person.FEMALE:
-                father_handle = family.get_father_handle()
                 if father_handle:
-                    husband = self.database.get_person_from_handle(father_handle)
-                    s2 = self.__make_person_parent(husband)
+                    s2 = self.__make_person_parent(father_handle)
             else:
-                mother_handle = family.get_mother_handle()
                 if mother_handle:
-                    wife = self.database.get_person_from_handle(mother_handle)
-                    s2 = self.__make_person_parent(wife)
+                    s2 = self.__make_person_parent(mother_handle)
             if s2 != '':
-                if s != '':
-                    s = s + ' \\\\\n'
-                s = s + s2
-        if s != '':
+                spouses.append(s2)
+        if spouses:
             if int(person.get_gender()) == Person.FEMALE:
                 title = "Супруг" # TODO
             else:
                 title = "Супруга" # TODO
-            self.__add_person_overview(title, s)
+            self.__add_person_overview(out, title, ' \\\\\n'.join(spouses))
                     
-        self.doc.write_text('\\fbEndPersonDescription\n')
-        self.doc.write_text('\\normalsize\n')
+        out.append('\\fbEndPersonDescription\n')
+        out.append('\\normalsize\n')
         
-        s = ''
         for note_handle in person.get_note_list():
-            note = self.database.get_note_from_handle(note_handle)
+            note = self.db.get_note_from_handle(note_handle)
             if int(note.get_type()) == NoteType.PERSON:
-                s = s + '\\fbNoteSeparator\n\n'
-                s = s + self.__prepare_tex_for_latex(note.get())
-                s = s + '\n\n'
-            
-        self.doc.write_text(s)
-        self.doc.end_paragraph()
+                out += ['\\fbNoteSeparator\n\n',
+                        _styled_text_to_latex(note.get_styledtext()), '\n\n']
+
+        return ''.join(out)
         
 
 #------------------------------------------------------------------------
@@ -462,9 +4188,18 @@ class FamilyBookOptions(MenuReportOptions):
     RECURSE_SIDE = 1
     RECURSE_ALL = 2
 
+    SCOPE_ALL = 0
+    SCOPE_ANCESTORS = 1
+    SCOPE_DESCENDANTS = 2
+    SCOPE_CONNECTED = 3
+
     def __init__(self, name, dbase):
         self.__db = dbase
         self.__pid = None
+        self.__scope = None
+        self.__scope_steps = None
+        self.__instrument = None
+        self.__profile_chapters = None
         MenuReportOptions.__init__(self, name, dbase)
 
     def get_subject(self):
@@ -486,6 +4221,161 @@ class FamilyBookOptions(MenuReportOptions):
         self.__pid.set_help(_("The person who is used to deterine the relatives' titles"))
         menu.add_option(category_name, "pid", self.__pid)
 
+        self.__scope = EnumeratedListOption(_("Persons"), self.SCOPE_ALL)
+        self.__scope.add_item(self.SCOPE_ALL, _("Whole database"))
+        self.__scope.add_item(self.SCOPE_ANCESTORS,
+                              _("Ancestors of the center person"))
+        self.__scope.add_item(self.SCOPE_DESCENDANTS,
+                              _("Descendants of the center person"))
+        self.__scope.add_item(self.SCOPE_CONNECTED,
+                              _("Relatives of the center person"))
+        self.__scope.set_help(_("Which persons get a chapter in the book"))
+        menu.add_option(category_name, "scope", self.__scope)
+        self.__scope.connect('value-changed', self.__scope_changed)
+
+        self.__scope_steps = NumberOption(_("Relationship steps"), 3, 1, 100)
+        self.__scope_steps.set_help(_("The maximum number of parent, child "
+                                      "or spouse links between a relative "
+                                      "and the center person"))
+        menu.add_option(category_name, "scope_steps", self.__scope_steps)
+        self.__scope_changed()
+
+        cache_size = NumberOption(_("Object cache size"), 200000, 0, 10000000)
+        cache_size.set_help(_("The maximum number of database objects kept "
+                              "in memory during the report run, 0 means "
+                              "no limit"))
+        menu.add_option(category_name, "cache_size", cache_size)
+
+        prefetch = BooleanOption(_("Prefetch events, families and citations"),
+                                 False)
+        prefetch.set_help(_("Whether to read the event, family, citation, "
+                            "source and note tables in one sequential scan "
+                            "before rendering instead of looking up each "
+                            "reference separately"))
+        menu.add_option(category_name, "prefetch", prefetch)
+
+        jobs = NumberOption(_("Parallel jobs"), 1, 1, 64)
+        jobs.set_help(_("The number of processes rendering person chapters "
+                        "in parallel"))
+        menu.add_option(category_name, "jobs", jobs)
+
+        pipeline_depth = NumberOption(_("Chapters read ahead"), 0, 0, 10000)
+        pipeline_depth.set_help(_("The number of chapters whose objects are "
+                                  "read ahead by separate threads and queued "
+                                  "for writing by another one, so that "
+                                  "database reads and output overlap the "
+                                  "rendering, e.g. on network storage; 0 "
+                                  "does everything in sequence. Chapters "
+                                  "are read ahead with one job and no "
+                                  "chapter cache"))
+        menu.add_option(category_name, "pipeline_depth", pipeline_depth)
+
+        streaming = BooleanOption(_("Low memory mode"), False)
+        streaming.set_help(_("Whether to keep the persons, places and "
+                             "citations of the book in temporary files "
+                             "instead of memory, sorting them on disk, so "
+                             "that very large trees are rendered in a "
+                             "bounded amount of memory; chapters are then "
+                             "rendered one at a time. Used with a LaTeX file"))
+        menu.add_option(category_name, "streaming", streaming)
+
+        chapter_cache = DestinationOption(_("Chapter cache"), '')
+        chapter_cache.set_help(_("The file keeping rendered chapters between "
+                                 "runs, so that only the chapters of changed "
+                                 "persons are rendered again; leave empty to "
+                                 "render all chapters"))
+        menu.add_option(category_name, "chapter_cache", chapter_cache)
+
+        tex_file = DestinationOption(_("LaTeX file"), '')
+        tex_file.set_help(_("The file the LaTeX source is written to directly, "
+                            "bypassing the selected output format; not used "
+                            "when the report is part of a book"))
+        menu.add_option(category_name, "tex_file", tex_file)
+
+        split_chapters = BooleanOption(_("One LaTeX file per chapter"), False)
+        split_chapters.set_help(_("Whether to write every chapter and the "
+                                  "bibliography into its own file included "
+                                  "from the LaTeX file, along with a manifest "
+                                  "of file hashes"))
+        menu.add_option(category_name, "split_chapters", split_chapters)
+
+        skip_unchanged = BooleanOption(_("Skip an unchanged book"), False)
+        skip_unchanged.set_help(_("Whether to compare a digest of the change "
+                                  "times of the persons of the book and of "
+                                  "the objects they refer to, and of the "
+                                  "options, with the one stored next to the "
+                                  "LaTeX file by the previous run, and leave "
+                                  "the book as it is if nothing changed"))
+        menu.add_option(category_name, "skip_unchanged", skip_unchanged)
+
+        relationships = BooleanOption(
+            _("Relationship to the center person"), True)
+        relationships.set_help(_("Whether the chapter of every blood "
+                                 "relative of the center person tells how "
+                                 "they are related"))
+        menu.add_option(category_name, "relationships", relationships)
+
+        batch_pids = StringOption(_("Batch center persons"), '')
+        batch_pids.set_help(_("Gramps IDs of center persons, separated by "
+                              "spaces or commas, to write a book for each "
+                              "from one snapshot of the database instead of "
+                              "the center person book; the person ID is "
+                              "appended to the LaTeX and chapter cache file "
+                              "names. Used with a LaTeX file only"))
+        menu.add_option(category_name, "batch_pids", batch_pids)
+
+        name_index = BooleanOption(_("Name index"), True)
+        name_index.set_help(_("Whether to end the book with an index of "
+                              "all the names, alternate ones included, of "
+                              "the persons of the book by surname"))
+        menu.add_option(category_name, "name_index", name_index)
+
+        photo_dir = DestinationOption(_("Portrait directory"), '')
+        photo_dir.set_help(_("The directory the portraits of the persons, "
+                             "cropped and scaled to the print size, are "
+                             "kept in between runs; leave empty to leave "
+                             "the portraits out"))
+        photo_dir.set_directory_entry(True)
+        menu.add_option(category_name, "photo_dir", photo_dir)
+
+        merge_citations = BooleanOption(_("Merge citations of the same page"),
+                                        False)
+        merge_citations.set_help(_("Whether citations of the same source "
+                                   "and page share one bibliography entry"))
+        menu.add_option(category_name, "merge_citations", merge_citations)
+
+        self.__instrument = BooleanOption(_("Write performance statistics"),
+                                          False)
+        self.__instrument.set_help(_("Whether to count and time database "
+                                     "reads, display helpers, output and "
+                                     "report phases, and write the results "
+                                     "as JSON next to the report"))
+        menu.add_option(category_name, "instrument", self.__instrument)
+        self.__instrument.connect('value-changed', self.__instrument_changed)
+
+        self.__profile_chapters = BooleanOption(
+            _("Profile chapter rendering"), False)
+        self.__profile_chapters.set_help(_("Whether to run the chapter loop "
+                                           "under cProfile and add the most "
+                                           "expensive functions to the "
+                                           "performance statistics"))
+        menu.add_option(category_name, "profile_chapters",
+                        self.__profile_chapters)
+        self.__instrument_changed()
+
+    def __instrument_changed(self):
+        """
+        Enable profiling with the performance statistics only.
+        """
+        self.__profile_chapters.set_available(self.__instrument.get_value())
+
+    def __scope_changed(self):
+        """
+        Enable the relationship steps option for the relatives scope only.
+        """
+        self.__scope_steps.set_available(
+            self.__scope.get_value() == self.SCOPE_CONNECTED)
+
     def __add_report_display(self, menu):
         """
         How to display names, datyes, ...
@@ -0,0 +1,116 @@
+"""
+Compare the memory taken by the person index of the Family Book report
+with the nested defaultdict structure it replaced.
+
+Usage: python bench_memory.py [--sizes 100k,500k] [--bkrefs N]
+"""
+
+#------------------------------------------------------------------------
+#
+# Standard Python modules
+#
+#------------------------------------------------------------------------
+import argparse
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+
+#------------------------------------------------------------------------
+#
+# Gramps modules
+#
+#------------------------------------------------------------------------
+from gramps.gen.lib import Family, Person
+
+#------------------------------------------------------------------------
+#
+# Benchmark modules
+#
+#------------------------------------------------------------------------
+from benchutil import FamilyBook
+from bench_synthetic import parse_size
+from synthetic import FEMALE_NAMES, MALE_NAMES, SURNAMES
+
+
+def make_persons(size, seed):
+    """
+    Return a list of (handle, name, gramps_id, sort key) of made up persons.
+    """
+    rnd = random.Random(seed)
+    persons = []
+    for i in range(size):
+        surname = rnd.choice(SURNAMES)
+        given = rnd.choice(MALE_NAMES + FEMALE_NAMES)
+        # handles and names are built like the database would return them,
+        # one string object per person
+        persons.append(('%016x%010d' % (rnd.getrandbits(64), i),
+                        '%s, %s' % (surname, given), 'I%06d' % i,
+                        (surname, given, rnd.randint(0, 2500000),
+                         'I%06d' % i)))
+    return persons
+
+def fill_legacy(persons, bkrefs):
+    """
+    Fill the nested dictionaries formerly used by the report.
+    """
+    obj_dict = defaultdict(lambda: defaultdict(set))
+    bkref_dict = defaultdict(lambda: defaultdict(set))
+    obj_dict[Person] = defaultdict(set)
+    sort_keys = []
+    for (handle, name, gramps_id, sort_key) in persons:
+        obj_dict[Person][handle] = [name, gramps_id, len(obj_dict[Person])]
+        sort_keys.append(sort_key)
+    for (handle, bkref_handle) in bkrefs:
+        bkref_dict[Person][handle].add((Family, bkref_handle, None))
+    return (obj_dict, bkref_dict, sort_keys)
+
+def fill_index(persons, bkrefs):
+    """
+    Fill the PersonIndex of the report.
+    """
+    index = FamilyBook.PersonIndex()
+    for (handle, name, gramps_id, sort_key) in persons:
+        index.add(handle, name, gramps_id, sort_key)
+    for (handle, bkref_handle) in bkrefs:
+        index.add_back_reference(handle, Family, bkref_handle)
+    return index
+
+def measure(fill, persons, bkrefs):
+    """
+    Return (allocated MB, seconds) of building a structure.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    structure = fill(persons, bkrefs)
+    elapsed = time.perf_counter() - start
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del structure
+    return (current / 1048576.0, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--sizes', default = '100k,500k',
+                        help = 'comma separated numbers of persons')
+    parser.add_argument('--bkrefs', type = float, default = 1.0,
+                        help = 'back references per person')
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+
+    for size in [parse_size(text) for text in args.sizes.split(',')]:
+        persons = make_persons(size, args.seed)
+        rnd = random.Random(args.seed)
+        bkrefs = [(rnd.choice(persons)[0], 'F%09d' % rnd.randrange(size))
+                  for i in range(int(size * args.bkrefs))]
+        print('%d persons, %d back references' % (size, len(bkrefs)))
+        print('    %-20s %14s %10s' % ('structure', 'allocated, MB',
+                                       'time, s'))
+        for (name, fill) in (('nested dictionaries', fill_legacy),
+                             ('PersonIndex', fill_index)):
+            (megabytes, seconds) = measure(fill, persons, bkrefs)
+            print('    %-20s %14.1f %10.2f' % (name, megabytes, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compare wall-clock time and the number of database calls of the Family
+Book report with and without the prefetch mode.
+
+The family tree is opened read-only; it must not be open in Gramps. With
+--jobs N the chapters are rendered in other processes, whose database
+calls are not counted: the counts cover the parent process only.
+
+Usage: python bench_prefetch.py "Family Tree Name" [--pid I0001] [--jobs N]
+"""
+
+#------------------------------------------------------------------------
+#
+# Standard Python modules
+#
+#------------------------------------------------------------------------
+import argparse
+import sys
+
+#------------------------------------------------------------------------
+#
+# Gramps modules
+#
+#------------------------------------------------------------------------
+from gramps.gen.db import DBMODE_R
+from gramps.gen.db.utils import lookup_family_tree, make_database
+
+#------------------------------------------------------------------------
+#
+# Benchmark modules
+#
+#------------------------------------------------------------------------
+from benchutil import CountingDatabase, run_report
+
+
+def open_tree(name):
+    """
+    Open the family tree read-only, exit if it is missing or locked.
+    """
+    data = lookup_family_tree(name)
+    if not data:
+        sys.exit('No family tree named %r' % name)
+    (path, locked, locked_by, backend) = data
+    if locked:
+        sys.exit('The family tree %r is locked by %s' % (name, locked_by))
+    database = make_database(backend)
+    database.load(path, mode = DBMODE_R)
+    return database
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('tree', help = 'name of the Gramps family tree')
+    parser.add_argument('--pid', default = '', help = 'center person ID')
+    parser.add_argument('--jobs', type = int, default = 1,
+                        help = 'number of chapter rendering processes')
+    args = parser.parse_args()
+
+    database = open_tree(args.tree)
+    try:
+        for prefetch in (False, True):
+            counting = CountingDatabase(database)
+            (elapsed, _doc, _report) = run_report(counting,
+                {'pid': args.pid, 'prefetch': prefetch, 'jobs': args.jobs})
+            lookups = sum(count for (name, count) in counting.calls.items()
+                          if name.endswith('_from_handle'))
+            print('prefetch=%-5s %8.2f s %10d DB calls %10d handle lookups'
+                  % (prefetch, elapsed, sum(counting.calls.values()),
+                     lookups))
+            for (name, count) in sorted(counting.calls.items()):
+                print('    %-32s %10d' % (name, count))
+    finally:
+        database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Run the Family Book report against synthetic genealogies of several sizes
+and print per-phase wall time, peak RSS and database call counts. With
+--jobs N the chapters are rendered in other processes, whose peak RSS and
+database calls are not counted.
+
+With --check the book is also written serially and with several chapter
+processes, a read-ahead pipeline and the low memory mode, and the texts
+are compared; the exit status is 1 if any differs.
+
+Usage: python bench_synthetic.py [--sizes 1k,10k,100k,500k] [--prefetch]
+                                 [--jobs N] [--streaming] [--pipeline K]
+                                 [--latency MS] [--check]
+"""
+
+#------------------------------------------------------------------------
+#
+# Standard Python modules
+#
+#------------------------------------------------------------------------
+import argparse
+import resource
+import sys
+import time
+
+#------------------------------------------------------------------------
+#
+# Gramps modules
+#
+#------------------------------------------------------------------------
+from gramps.gen.lib import Person
+
+#------------------------------------------------------------------------
+#
+# Benchmark modules
+#
+#------------------------------------------------------------------------
+from benchutil import CountingDatabase, run_report
+from synthetic import generate
+
+#------------------------------------------------------------------------
+#
+# Constants
+#
+#------------------------------------------------------------------------
+PHASES = ('_build_obj_dict', '_build_relationships', '_sort_persons',
+          '_write_chapters', '_write_places', '_write_bibliography',
+          '_write_name_index')
+
+# options which must not change the text of the book: the option name
+# and the least value checked against a serial run
+CHECKED_OPTIONS = (('jobs', 2), ('pipeline_depth', 4), ('streaming', True))
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    if text.endswith('k'):
+        return int(float(text[:-1]) * 1000)
+    return int(text)
+
+def peak_rss():
+    """
+    Return the peak resident set size of the process in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def time_phases(report, counting, results):
+    """
+    Wrap the phase methods of the report with timers.
+    """
+    for name in PHASES:
+        method = getattr(report, name)
+
+        def timed(*args, __method = method, __name = name, **kwargs):
+            calls = sum(counting.calls.values())
+            start = time.perf_counter()
+            try:
+                return __method(*args, **kwargs)
+            finally:
+                results.append((__name, time.perf_counter() - start,
+                                 peak_rss(),
+                                 sum(counting.calls.values()) - calls))
+        setattr(report, name, timed)
+
+def check_output(database, values, digest):
+    """
+    Write the book serially and with each of the CHECKED_OPTIONS, and
+    compare the texts with each other and with the measured run.
+
+    @param digest: digest of the text of the measured run
+    @return: True if all the texts are the same
+    """
+    serial = dict(values, jobs = 1, pipeline_depth = 0, streaming = False)
+    (elapsed, doc, report) = run_report(database, serial)
+    reference = doc.get_digest()
+    same = digest == reference
+    print('    check: measured run %s the serial run'
+          % ('matches' if same else 'DIFFERS FROM'))
+    for (name, value) in CHECKED_OPTIONS:
+        value = max(value, values[name])
+        (elapsed, doc, report) = run_report(database,
+                                            dict(serial, **{name: value}))
+        matches = doc.get_digest() == reference
+        print('    check: %s = %s %s the serial run'
+              % (name, value, 'matches' if matches else 'DIFFERS FROM'))
+        same = same and matches
+    return same
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--sizes', default = '1k,10k',
+                        help = 'comma separated numbers of persons')
+    parser.add_argument('--prefetch', action = 'store_true',
+                        help = 'use the prefetch mode')
+    parser.add_argument('--jobs', type = int, default = 1,
+                        help = 'number of chapter rendering processes')
+    parser.add_argument('--streaming', action = 'store_true',
+                        help = 'use the low memory mode')
+    parser.add_argument('--pipeline', type = int, default = 0,
+                        help = 'number of chapters read ahead')
+    parser.add_argument('--latency', type = float, default = 0.0,
+                        help = 'milliseconds every object read waits')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'compare the text with the serial output')
+    args = parser.parse_args()
+
+    failed = False
+    for size in [parse_size(text) for text in args.sizes.split(',')]:
+        start = time.perf_counter()
+        database = generate(size, args.seed)
+        database.latency = args.latency / 1000.0
+        print('%d persons: generated in %.1f s, peak RSS %.0f MB'
+              % (size, time.perf_counter() - start, peak_rss()))
+
+        counting = CountingDatabase(database)
+        results = []
+        values = {'prefetch': args.prefetch, 'jobs': args.jobs,
+                  'streaming': args.streaming,
+                  'pipeline_depth': args.pipeline,
+                  # the youngest person has the most ancestors
+                  'pid': 'I%06d' % (size - 1)}
+        (elapsed, doc, report) = run_report(
+            counting, values,
+            lambda report: time_phases(report, counting, results))
+        print('    %-20s %10s %14s %12s' % ('phase', 'time, s',
+                                            'peak RSS, MB', 'DB calls'))
+        for (name, seconds, rss, calls) in results:
+            print('    %-20s %10.2f %14.0f %12d' % (name, seconds, rss, calls))
+        print('    %-20s %10.2f %14.0f %12d' % ('total', elapsed, peak_rss(),
+                                                sum(counting.calls.values())))
+        print('    %d chapters, %d characters written'
+              % (len(report.obj_dict[Person]), doc.length))
+        for (name, stats) in report.pipeline_stats.items():
+            print('    %s queue: mean depth %.1f, producer stalled %.2f s, '
+                  'consumer stalled %.2f s'
+                  % (name, stats['mean_depth'], stats['producer_stall'],
+                     stats['consumer_stall']))
+        if args.check:
+            database.latency = 0.0
+            if not check_output(database, values, doc.get_digest()):
+                failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Helpers shared by the Family Book benchmarks"""
+
+#------------------------------------------------------------------------
+#
+# Standard Python modules
+#
+#------------------------------------------------------------------------
+import hashlib
+import os
+import sys
+import time
+from collections import Counter
+
+#------------------------------------------------------------------------
+#
+# Gramps modules
+#
+#------------------------------------------------------------------------
+from gramps.gen.user import User
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import FamilyBook
+
+
+#------------------------------------------------------------------------
+#
+# NullDoc
+#
+#------------------------------------------------------------------------
+class NullDoc(object):
+    """
+    Document generator stand-in which only counts what is written and
+    hashes it, to compare the output of runs without keeping it.
+    """
+
+    def __init__(self):
+        self.paragraphs = 0
+        self.calls = 0
+        self.length = 0
+        self.sha256 = hashlib.sha256()
+
+    def set_creator(self, creator):
+        pass
+
+    def set_rtl_doc(self, value):
+        pass
+
+    def open(self, filename):
+        pass
+
+    def close(self):
+        pass
+
+    def start_paragraph(self, style_name, leader = None):
+        self.paragraphs += 1
+        self.sha256.update(b'\0' + style_name.encode('utf-8') + b'\0')
+
+    def end_paragraph(self):
+        pass
+
+    def write_text(self, text, mark = None, links = False):
+        self.calls += 1
+        self.length += len(text)
+        self.sha256.update(text.encode('utf-8'))
+
+    def get_digest(self):
+        """
+        Return the hex digest of the paragraphs and the text written.
+        """
+        return self.sha256.hexdigest()
+
+
+#------------------------------------------------------------------------
+#
+# CountingDatabase
+#
+#------------------------------------------------------------------------
+class CountingDatabase(object):
+    """
+    Database proxy counting the calls of every database method.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if not callable(attr):
+            return attr
+        calls = self.calls
+
+        def counted(*args, **kwargs):
+            calls[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+#------------------------------------------------------------------------
+#
+# Functions
+#
+#------------------------------------------------------------------------
+def run_report(database, values, prepare = None):
+    """
+    Run the Family Book report against the database.
+
+    @param database: the Gramps database instance (or a stand-in)
+    @param values: dictionary of report option values
+    @param prepare: optional function called with the report instance
+        before the report is written
+    @return: tuple of (elapsed seconds, NullDoc instance, report)
+    """
+    options = FamilyBook.FamilyBookOptions('FamilyBook', database)
+    options.load_previous_values()
+    for (name, value) in values.items():
+        options.menu.get_option_by_name(name).set_value(value)
+    doc = NullDoc()
+    options.set_document(doc)
+    options.set_output(None)
+
+    start = time.perf_counter()
+    report = FamilyBook.FamilyBook(database, options, User())
+    if prepare is not None:
+        prepare(report)
+    report.write_report()
+    return (time.perf_counter() - start, doc, report)
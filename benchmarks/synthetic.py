@@ -0,0 +1,322 @@
+"""
+Synthetic genealogy generator and an in-memory database stand-in
+implementing the part of the Gramps database API used by the Family Book
+report.
+"""
+
+#------------------------------------------------------------------------
+#
+# Standard Python modules
+#
+#------------------------------------------------------------------------
+import random
+import time
+
+#------------------------------------------------------------------------
+#
+# Gramps modules
+#
+#------------------------------------------------------------------------
+from gramps.gen.lib import (ChildRef, Citation, Date, Event, EventRef,
+                            EventRoleType, EventType, Family, Name, NameType,
+                            Note, NoteType, Person, Place, PlaceName,
+                            PlaceRef, PlaceType, Researcher, Source, Surname)
+
+#------------------------------------------------------------------------
+#
+# Constants
+#
+#------------------------------------------------------------------------
+SURNAMES = ['Иванов', 'Петров', 'Сидоров', 'Кузнецов', 'Смирнов', 'Попов',
+            'Васильев', 'Соколов', 'Михайлов', 'Новиков', 'Фёдоров',
+            'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров',
+            'Павлов', 'Козлов', 'Степанов', 'Николаев', 'Орлов', 'Андреев',
+            'Макаров', 'Никитин', 'Захаров', 'Зайцев', 'Соловьёв', 'Борисов']
+MALE_NAMES = ['Иван', 'Пётр', 'Алексей', 'Николай', 'Михаил', 'Фёдор',
+              'Василий', 'Григорий', 'Степан', 'Андрей', 'Дмитрий', 'Яков']
+FEMALE_NAMES = ['Мария', 'Анна', 'Екатерина', 'Ольга', 'Татьяна', 'Анастасия',
+                'Евдокия', 'Пелагея', 'Прасковья', 'Ирина', 'Александра']
+
+# share of persons having the event (or note)
+BIRTH_RATIO = 0.6
+DEATH_RATIO = 0.4
+BURIAL_RATIO = 0.25
+NOTE_RATIO = 0.15
+# share of events citing a source
+CITED_RATIO = 0.6
+# share of events without a date, stored as None in the raw data
+UNDATED_RATIO = 0.05
+# objects per person
+FAMILY_RATIO = 0.3
+CITATION_RATIO = 0.2
+SOURCE_RATIO = 0.005
+PLACE_RATIO = 0.005
+
+
+#------------------------------------------------------------------------
+#
+# SyntheticDatabase
+#
+#------------------------------------------------------------------------
+class SyntheticDatabase(object):
+    """
+    In-memory database stand-in keeping serialized objects, so that every
+    get_*_from_handle call pays the deserialization like a real backend.
+    """
+
+    TABLES = {'person': Person, 'family': Family, 'event': Event,
+              'citation': Citation, 'source': Source, 'place': Place,
+              'note': Note}
+
+    # seconds every get_*_from_handle call waits, e.g. to mimic a database
+    # on network storage
+    latency = 0.0
+
+    def __init__(self):
+        self.tables = dict((name, {}) for name in self.TABLES)
+        self.gramps_ids = {}
+        self.name_formats = []
+        for (name, obj_class) in self.TABLES.items():
+            self.__add_accessors(name, obj_class)
+
+    def __add_accessors(self, name, obj_class):
+        table = self.tables[name]
+
+        def get_from_handle(handle):
+            if self.latency:
+                time.sleep(self.latency)
+            return obj_class().unserialize(table[handle])
+
+        def get_raw_data(handle):
+            return table.get(handle)
+
+        def get_cursor():
+            return _Cursor(table)
+
+        setattr(self, 'get_%s_from_handle' % name, get_from_handle)
+        setattr(self, 'get_raw_%s_data' % name, get_raw_data)
+        setattr(self, 'get_%s_cursor' % name, get_cursor)
+
+    def add(self, obj):
+        """
+        Store a primary object.
+        """
+        name = obj.__class__.__name__.lower()
+        self.tables[name][obj.handle] = obj.serialize()
+        if name == 'person':
+            self.gramps_ids[obj.gramps_id] = obj.handle
+
+    def iter_person_handles(self):
+        return iter(list(self.tables['person']))
+
+    def get_number_of_people(self):
+        return len(self.tables['person'])
+
+    def get_person_from_gramps_id(self, gramps_id):
+        handle = self.gramps_ids.get(gramps_id)
+        if handle is None:
+            return None
+        return self.get_person_from_handle(handle)
+
+    def get_researcher(self):
+        return Researcher()
+
+    def get_save_path(self):
+        return ''
+
+    def close(self):
+        pass
+
+class _Cursor(object):
+    """
+    Context manager iterating over (handle, raw data) pairs of a table.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return iter(list(self.table.items()))
+
+    def __exit__(self, *args):
+        return False
+
+
+#------------------------------------------------------------------------
+#
+# Functions
+#
+#------------------------------------------------------------------------
+def _make_date(rnd, year):
+    date = Date()
+    if rnd.random() < 0.8:
+        date.set_yr_mon_day(year, rnd.randint(1, 12), rnd.randint(1, 28))
+    else:
+        date.set(Date.QUAL_NONE, Date.MOD_ABOUT, Date.CAL_GREGORIAN,
+                 (0, 0, year, False))
+    return date
+
+def generate(size, seed = 1):
+    """
+    Generate a synthetic genealogy of the given number of persons.
+
+    @param size: number of persons
+    @param seed: seed of the random generator
+    @return: SyntheticDatabase instance
+    """
+    rnd = random.Random(seed)
+    db = SyntheticDatabase()
+
+    # sources, citations and a country/region/village place hierarchy
+    sources = []
+    for i in range(max(1, int(size * SOURCE_RATIO))):
+        source = Source()
+        source.set_handle('S%09d' % i)
+        source.set_gramps_id('S%05d' % i)
+        source.set_title('Метрическая книга церкви № %d' % i)
+        if i % 2:
+            source.set_author('Духовная консистория')
+        if i % 3:
+            source.set_publication_info('ЦГИА, ф. %d' % (i + 100))
+        db.add(source)
+        sources.append(source.handle)
+
+    citations = []
+    for i in range(max(1, int(size * CITATION_RATIO))):
+        citation = Citation()
+        citation.set_handle('C%09d' % i)
+        citation.set_gramps_id('C%05d' % i)
+        citation.set_reference_handle(rnd.choice(sources))
+        citation.set_page('оп. %d, д. %d, л. %d' % (rnd.randint(1, 20),
+                                                    rnd.randint(1, 900),
+                                                    rnd.randint(1, 300)))
+        db.add(citation)
+        citations.append(citation.handle)
+
+    parents = [None]
+    for (level, place_type, title, count) in (
+            (0, PlaceType.COUNTRY, 'Страна', 1),
+            (1, PlaceType.PROVINCE, 'Губерния', 10),
+            (2, PlaceType.VILLAGE, 'Село', max(10, int(size * PLACE_RATIO)))):
+        level_places = []
+        for i in range(count):
+            place = Place()
+            place.set_handle('L%d%08d' % (level, i))
+            place.set_gramps_id('P%d%05d' % (level, i))
+            place.set_name(PlaceName(value = '%s %d' % (title, i)))
+            place.set_type(place_type)
+            parent = rnd.choice(parents)
+            if parent:
+                placeref = PlaceRef()
+                placeref.ref = parent
+                place.add_placeref(placeref)
+            db.add(place)
+            level_places.append(place.handle)
+        parents = level_places
+    places = parents
+
+    # the family structure: persons are generated in birth order, children
+    # are attached to families of earlier persons
+    genders = [rnd.random() < 0.5 for i in range(size)]
+    parent_family = [None] * size
+    families = []
+    males = []
+    females = []
+    for i in range(size):
+        if families and rnd.random() < 0.8:
+            index = rnd.randrange(max(0, len(families) - 200), len(families))
+            families[index][2].append(i)
+            parent_family[i] = index
+        (males if genders[i] else females).append(i)
+        if males and females and rnd.random() < FAMILY_RATIO:
+            families.append([rnd.choice(males[-100:]),
+                             rnd.choice(females[-100:]), []])
+    own_families = [[] for i in range(size)]
+    for (index, (father, mother, children)) in enumerate(families):
+        own_families[father].append(index)
+        own_families[mother].append(index)
+
+    event_count = [0]
+    def add_event(event_type, year):
+        event = Event()
+        event.set_handle('E%09d' % event_count[0])
+        event.set_gramps_id('E%06d' % event_count[0])
+        event_count[0] += 1
+        event.set_type(event_type)
+        if rnd.random() >= UNDATED_RATIO:
+            event.set_date_object(_make_date(rnd, year))
+        if rnd.random() < 0.9:
+            event.set_place_handle(rnd.choice(places))
+        while rnd.random() < CITED_RATIO:
+            event.add_citation(rnd.choice(citations))
+        if rnd.random() < 0.05:
+            event.set_description('по записи в метрической книге')
+        db.add(event)
+        return event.handle
+
+    for i in range(size):
+        person = Person()
+        person.set_handle('I%09d' % i)
+        person.set_gramps_id('I%06d' % i)
+        person.set_gender(Person.MALE if genders[i] else Person.FEMALE)
+        name = Name()
+        surname = Surname()
+        surname.set_surname(rnd.choice(SURNAMES) if rnd.random() < 0.95 else '')
+        name.add_surname(surname)
+        name.set_first_name(rnd.choice(MALE_NAMES if genders[i] else FEMALE_NAMES))
+        if not genders[i] and own_families[i]:
+            name.set_type(NameType.MARRIED)
+            alt_name = Name()
+            alt_surname = Surname()
+            alt_surname.set_surname(rnd.choice(SURNAMES))
+            alt_name.add_surname(alt_surname)
+            alt_name.set_type(NameType.BIRTH)
+            person.add_alternate_name(alt_name)
+        person.set_primary_name(name)
+
+        year = 1700 + (i * 250) // size
+        for (ratio, event_type, offset, setter) in (
+                (BIRTH_RATIO, EventType.BIRTH, 0, person.set_birth_ref),
+                (DEATH_RATIO, EventType.DEATH, 60, person.set_death_ref),
+                (BURIAL_RATIO, EventType.BURIAL, 60, None)):
+            if rnd.random() < ratio:
+                event_ref = EventRef()
+                event_ref.ref = add_event(event_type, year + offset)
+                person.add_event_ref(event_ref)
+                if setter:
+                    setter(event_ref)
+
+        if rnd.random() < NOTE_RATIO:
+            note = Note(' '.join(['Запись из метрической книги.'] *
+                                 rnd.randint(1, 40)))
+            note.set_handle('N%09d' % i)
+            note.set_gramps_id('N%06d' % i)
+            note.set_type(NoteType.PERSON)
+            db.add(note)
+            person.add_note(note.handle)
+
+        if parent_family[i] is not None:
+            person.add_parent_family_handle('F%09d' % parent_family[i])
+        for index in own_families[i]:
+            person.add_family_handle('F%09d' % index)
+        db.add(person)
+
+    for (index, (father, mother, children)) in enumerate(families):
+        family = Family()
+        family.set_handle('F%09d' % index)
+        family.set_gramps_id('F%06d' % index)
+        family.set_father_handle('I%09d' % father)
+        family.set_mother_handle('I%09d' % mother)
+        for child in children:
+            child_ref = ChildRef()
+            child_ref.ref = 'I%09d' % child
+            family.add_child_ref(child_ref)
+        if rnd.random() < 0.6:
+            event_ref = EventRef()
+            event_ref.ref = add_event(EventType.MARRIAGE,
+                                      1720 + (father * 250) // size)
+            event_ref.set_role(EventRoleType.FAMILY)
+            family.add_event_ref(event_ref)
+        db.add(family)
+
+    return db